@@ -1,8 +1,61 @@
-import requests
+import httpx
+import asyncio
 import pandas as pd
 import base64
 import csv
+import json
+import os
 import time
+import random
+import sqlite3
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+# Spotify Web API search and token endpoints
+SEARCH_URL = "https://api.spotify.com/v1/search"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+# Refresh the access token this many seconds before Spotify says it expires
+TOKEN_REFRESH_MARGIN = 60
+
+# Request rate shared by all concurrent lookups (requests per second) at the start of a run, and how
+# many lookups may be in flight at once
+REQUESTS_PER_SECOND = 10.0
+MAX_CONCURRENT_REQUESTS = 10
+
+# Adaptive rate: every second of successful responses adds RATE_INCREASE requests per second, a 429
+# halves the rate and pauses all lookups for its Retry-After. The rate stays within these bounds.
+RATE_INCREASE = 1.0
+MIN_REQUESTS_PER_SECOND = 0.5
+MAX_REQUESTS_PER_SECOND = 100.0
+
+# Retries of one lookup (429, 5xx, network errors); 5xx and network errors wait a random time of up
+# to BACKOFF_BASE * 2 ** attempt seconds (at most BACKOFF_MAX) before the next try
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+DEFAULT_RETRY_AFTER = 1.0
+
+# Rows looked up before the partial result file is saved (and, when streaming, read at a time)
+BATCH_SIZE = 1000
+
+# Result files, and where a streaming run records how far it got
+RESULT_FILE = "releases_with_spotify_status.csv"
+PARTIAL_FILE = "releases_with_spotify_status_partial.csv"
+CHECKPOINT_FILE = "releases_with_spotify_status_partial.checkpoint.json"
+
+# Without the cache, answers for this many recently seen UPCs are kept in memory, so duplicates in
+# later batches are not looked up again (the cache does this itself and is not bounded by memory)
+KNOWN_UPCS = 100000
+
+# Lookup cache (SQLite, keyed by normalized UPC). A found release is trusted for HIT_TTL seconds. A
+# miss is rechecked after MISS_TTL (a bit under a day, so daily runs recheck new misses), doubling
+# with every further miss up to MAX_MISS_TTL: releases absent for months are probed less and less.
+CACHE_PATH = "spotify_upc_cache.sqlite3"
+HIT_TTL = 30 * 24 * 3600
+MISS_TTL = 20 * 3600
+MAX_MISS_TTL = 60 * 24 * 3600
+
 
 # Detect CSV delimiter automatically
 def detect_delimiter(csv_file):
@@ -13,44 +66,289 @@ def detect_delimiter(csv_file):
         return dialect.delimiter
 
 
-# Load releases data from CSV file
-def load_releases(csv_file):
-    delimiter = detect_delimiter(csv_file)
+# Load releases data from CSV file (as an iterator of DataFrames of chunksize rows, if given)
+def load_releases(csv_file, delimiter, chunksize=None):
     releases = pd.read_csv(
         csv_file,
         delimiter=delimiter,
         dtype=str,
         quoting=csv.QUOTE_NONE,
         on_bad_lines="skip",
+        chunksize=chunksize,
     )
-    return releases, delimiter
+    return releases
 
 
-# Search album on Spotify by UPC code
-def search_spotify(upc, token):
-    url = "https://api.spotify.com/v1/search"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+# A product code as delivered, without the quotes and spaces exports add; None for empty cells (NaN)
+def clean_upc(upc):
+    if not isinstance(upc, str):
+        return None
+    return upc.strip().strip("\"'").strip()
+
+
+# Canonical form of a product code: the EAN-13 for a valid UPC-A (12 digits) or EAN-13, else None.
+# A UPC-A is the same product as the EAN-13 with a leading zero, so both spellings group and cache
+# together.
+def normalize_upc(upc):
+    code = clean_upc(upc)
+    if code is None or not code.isdigit() or not code.isascii() or len(code) not in (12, 13):
+        return None
+    code = code.zfill(13)
+    # GS1 check digit: weights 1 and 3 alternate over the first 12 digits
+    total = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(code[:12]))
+    if (10 - total % 10) % 10 != int(code[12]):
+        return None
+    return code
+
+
+# When a lookup result should be checked again
+def next_check(found, misses, checked_at):
+    if found:
+        return checked_at + HIT_TTL
+    return checked_at + min(MAX_MISS_TTL, MISS_TTL * 2 ** (misses - 1))
+
+
+# Persistent lookup results: found, album ID/URL, when it was checked, consecutive misses and when
+# it is due for a recheck
+class UpcCache:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS upc_cache ("
+            " upc TEXT PRIMARY KEY,"
+            " found INTEGER NOT NULL,"
+            " album_id TEXT NOT NULL,"
+            " album_url TEXT NOT NULL,"
+            " checked_at REAL NOT NULL,"
+            " misses INTEGER NOT NULL,"
+            " due_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    # {upc: row} of the given UPCs that are in the cache
+    def get_many(self, upcs):
+        rows = {}
+        upcs = list(upcs)
+        # Stay below SQLite's limit on query parameters
+        for start in range(0, len(upcs), 500):
+            chunk = upcs[start:start + 500]
+            cursor = self.connection.execute(
+                "SELECT upc, found, album_id, album_url, checked_at, misses, due_at FROM upc_cache"
+                f" WHERE upc IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in cursor:
+                rows[row[0]] = {
+                    "found": bool(row[1]),
+                    "album_id": row[2],
+                    "album_url": row[3],
+                    "checked_at": row[4],
+                    "misses": row[5],
+                    "due_at": row[6],
+                }
+        return rows
+
+    # Store {upc: (found, album_url)}; previous holds the rows get_many returned for them
+    def put_many(self, results, previous, checked_at):
+        records = []
+        for upc, (found, album_url) in results.items():
+            misses = 0
+            if not found:
+                old = previous.get(upc)
+                misses = old["misses"] + 1 if old and not old["found"] else 1
+            album_id = album_url.rsplit("/", 1)[-1] if found else ""
+            records.append((
+                upc, int(found), album_id, album_url, checked_at, misses, next_check(found, misses, checked_at),
+            ))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO upc_cache"
+            " (upc, found, album_id, album_url, checked_at, misses, due_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            records,
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+# Async token bucket: on average `rate` requests per second, with bursts of up to one second's worth.
+# The rate adapts to Spotify's answers (additive increase, multiplicative decrease), and a 429 pauses
+# every lookup until its Retry-After has passed.
+class TokenBucket:
+    def __init__(self, rate, min_rate=MIN_REQUESTS_PER_SECOND, max_rate=MAX_REQUESTS_PER_SECOND):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate)
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # Last time a request had to wait for a token, i.e. the rate (not the concurrency) was the limit
+        self.waited_at = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so requests go out in the order they asked
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.waited_at = now
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def speed_up(self):
+        # Called for every successful response: about RATE_INCREASE more requests/s per second, but only
+        # while requests wait for tokens. Otherwise the concurrency cap is what limits the throughput,
+        # and a higher rate would only wind up past what is actually sent.
+        if self.waited_at is not None and time.monotonic() - self.waited_at < 1.0:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+    def slow_down(self, retry_after):
+        # Called on a 429. Answers to requests sent before the pause started do not halve the rate again.
+        now = time.monotonic()
+        if now >= self.paused_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+            print(f"Rate limited by Spotify: pausing {retry_after:g} s, continuing at {self.rate:.1f} requests/s.")
+        self.paused_until = max(self.paused_until, now + retry_after)
+        # Nothing accumulates during the pause, so it does not end in a burst
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+# Seconds to wait from a Retry-After header (seconds or an HTTP date)
+def parse_retry_after(value):
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+# Access token shared by all lookup workers: cached until shortly before it expires,
+# refreshed by one worker while the others wait for it
+class SpotifyToken:
+    def __init__(self, client_id, client_secret, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0.0
+        self.lock = asyncio.Lock()
+
+    def valid(self):
+        return self.access_token is not None and time.monotonic() < self.expires_at
+
+    async def get(self, client):
+        if not self.valid():
+            async with self.lock:
+                # Another worker may have refreshed it while this one waited for the lock
+                if not self.valid():
+                    await self.refresh(client)
+        return self.access_token
+
+    async def rejected(self, client, access_token):
+        # Called on a 401: refresh, unless another worker already replaced the rejected token
+        async with self.lock:
+            if self.access_token == access_token:
+                await self.refresh(client)
+        return self.access_token
+
+    async def refresh(self, client):
+        access_token, expires_in = await get_spotify_token(client, self.client_id, self.client_secret)
+        self.access_token = access_token
+        # Short-lived tokens are refreshed halfway through instead
+        self.expires_at = time.monotonic() + expires_in - min(self.refresh_margin, expires_in / 2)
+        print(f"Spotify access token refreshed, valid for {expires_in} s.")
+
+
+# Search album on Spotify by UPC code. Returns (found, album_url), or None if Spotify gave no answer
+# (still rate limited, server errors, network errors): only an empty search result is a miss.
+async def search_spotify(client, upc, tokens, bucket):
     params = {
         "q": f"upc:{upc}",
         "type": "album",
     }
-    response = requests.get(url, headers=headers, params=params)
-    # Add a 2-second pause after each request to reduce rate limiting risk
-    time.sleep(2)
-    if response.status_code == 200:
-        data = response.json()
-        if data["albums"]["items"]:
-            album_id = data["albums"]["items"][0]["id"]
-            album_url = f"https://open.spotify.com/album/{album_id}"
-            return True, album_url
-    return False, ""
+    token_refreshed = False
+    for attempt in range(MAX_ATTEMPTS):
+        access_token = await tokens.get(client)
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+        }
+        await bucket.acquire()
+        try:
+            response = await client.get(SEARCH_URL, headers=headers, params=params)
+        except httpx.TransportError as e:
+            print(f"UPC {upc}: {type(e).__name__}, retrying.")
+            response = None
+
+        if response is None or response.status_code >= 500:
+            # Jittered exponential backoff for this lookup only
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+        elif response.status_code == 429:
+            # Every lookup waits (see TokenBucket.slow_down), so no sleep of its own here
+            bucket.slow_down(parse_retry_after(response.headers.get("Retry-After")))
+        elif response.status_code == 401 and not token_refreshed:
+            # The token expired or was revoked early: get a new one and retry
+            await tokens.rejected(client, access_token)
+            token_refreshed = True
+        elif response.status_code == 200:
+            bucket.speed_up()
+            data = response.json()
+            if data["albums"]["items"]:
+                album_id = data["albums"]["items"][0]["id"]
+                album_url = f"https://open.spotify.com/album/{album_id}"
+                return True, album_url
+            return False, ""
+        else:
+            print(f"UPC {upc}: Spotify answered {response.status_code}, leaving the row unchanged.")
+            return None
+    print(f"UPC {upc}: no answer after {MAX_ATTEMPTS} attempts, leaving the row unchanged.")
+    return None
+
 
+# Search a canonical EAN-13 on Spotify. Spotify matches the code as the label delivered it, so that
+# spelling (default: the EAN-13) is searched first; only a miss on a zero-led code also tries the
+# other one, the 12-digit UPC-A or the EAN-13.
+async def search_code(client, code, tokens, bucket, delivered=None):
+    spellings = [delivered or code]
+    if code.startswith("0"):
+        spellings.append(code if spellings[0] != code else code[1:])
+    for spelling in spellings:
+        result = await search_spotify(client, spelling, tokens, bucket)
+        if result is None or result[0]:
+            break
+    return result
 
-# Get Spotify access token
-def get_spotify_token(client_id, client_secret):
-    url = "https://accounts.spotify.com/api/token"
+
+# Look up many codes concurrently: codes -> {code: (found, album_url) or None}. delivered maps a
+# code to its spelling in the sheet, see search_code.
+async def check_upcs(client, codes, tokens, bucket, max_concurrency=MAX_CONCURRENT_REQUESTS, delivered=None):
+    results = {}
+    delivered = delivered or {}
+    # All workers pull from the same iterator, so at most max_concurrency lookups are in flight
+    pending = iter(codes)
+
+    async def worker():
+        for code in pending:
+            results[code] = await search_code(client, code, tokens, bucket, delivered.get(code))
+
+    await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+    return results
+
+
+# Get a Spotify access token and its lifetime in seconds
+async def get_spotify_token(client, client_id, client_secret):
     auth_str = f"{client_id}:{client_secret}"
     b64_auth_str = base64.b64encode(auth_str.encode()).decode()
 
@@ -61,24 +359,122 @@ def get_spotify_token(client_id, client_secret):
     data = {
         "grant_type": "client_credentials",
     }
-    response = requests.post(url, headers=headers, data=data)
-    print("Response status code:", response.status_code)
-    print("Response content:", response.text)
+    response = await client.post(TOKEN_URL, headers=headers, data=data)
     if response.status_code == 200:
-        return response.json()["access_token"]
+        token_data = response.json()
+        return token_data["access_token"], token_data.get("expires_in", 3600)
     else:
+        print("Token request failed with status code:", response.status_code)
         response.raise_for_status()
 
 
-# Main function to execute the process
-def main(csv_file, client_id, client_secret):
-    # Load releases and detect delimiter
-    releases, delimiter = load_releases(csv_file)
+# Everything the lookups of one run share: HTTP client, access token, rate limit and cache
+class LookupSession:
+    def __init__(self, client_id, client_secret, requests_per_second, max_concurrency, cache_path):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.requests_per_second = requests_per_second
+        self.max_concurrency = max_concurrency
+        self.cache_path = cache_path
+        # Without a cache: recent answers of this run, least recently used first
+        self.known = OrderedDict()
 
-    # Assume UPC is in the first column
-    upc_column = releases.columns[0]
+    async def __aenter__(self):
+        self.tokens = SpotifyToken(self.client_id, self.client_secret)
+        self.bucket = TokenBucket(self.requests_per_second)
+        self.cache = UpcCache(self.cache_path) if self.cache_path else None
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        self.client = httpx.AsyncClient(limits=limits, timeout=30.0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        if self.cache is not None:
+            self.cache.close()
+
+    # Look up the given rows of a frame that need it and fill in their Spotify columns
+    async def check_rows(self, frame, indexes, upc_column):
+        # Plan first: group the rows by canonical code, so every code is looked up once, under the
+        # spelling its first row delivered
+        groups = {}
+        delivered = {}
+        invalid = {}
+        for index in indexes:
+            spotify_status = frame.at[index, "Spotify"]
+            spotify_link = frame.at[index, "Spotify Link"]
+
+            if spotify_status == "+" and spotify_link:
+                # Skip already processed row
+                continue
+            # '-' rows are rechecked in case the release appears on Spotify now,
+            # empty ones get a normal check
+            upc = frame.at[index, upc_column]
+            code = normalize_upc(upc)
+            if code is None:
+                invalid.setdefault(upc if isinstance(upc, str) else "", []).append(index)
+            else:
+                groups.setdefault(code, []).append(index)
+                delivered.setdefault(code, clean_upc(upc))
+        if invalid:
+            # Not worth a request: report them and leave the rows as they are
+            print(f"{sum(map(len, invalid.values()))} rows skipped, their UPC is not a valid UPC-A or EAN-13:")
+            for upc, rows in invalid.items():
+                print(f"  {upc!r}: {len(rows)} row(s)")
+
+        results = {}
+        for code in groups:
+            if code in self.known:
+                self.known.move_to_end(code)
+                results[code] = self.known[code]
+        due = [code for code in groups if code not in results]
+
+        # Codes checked recently enough take the cached result, only due ones hit Spotify
+        cached = {}
+        if self.cache is not None and due:
+            now = time.time()
+            cached = self.cache.get_many(due)
+            hits = 0
+            for code in due:
+                entry = cached.get(code)
+                if entry is not None and entry["due_at"] > now:
+                    results[code] = entry["found"], entry["album_url"]
+                    hits += 1
+            due = [code for code in due if code not in results]
+            if hits:
+                print(f"{hits} UPCs taken from the cache, {len(due)} due for a lookup.")
+
+        # Look them up concurrently within the rate limit
+        looked_up = await check_upcs(self.client, due, self.tokens, self.bucket, self.max_concurrency, delivered)
+        answered = {code: result for code, result in looked_up.items() if result is not None}
+        if self.cache is not None:
+            self.cache.put_many(answered, cached, time.time())
+        else:
+            self.known.update(answered)
+            while len(self.known) > KNOWN_UPCS:
+                self.known.popitem(last=False)
+        results.update(looked_up)
+        if len(groups) < sum(map(len, groups.values())):
+            print(f"{sum(map(len, groups.values()))} rows share {len(groups)} distinct UPCs.")
 
-    # Ensure 'Spotify' and 'Spotify Link' columns exist
+        failed = 0
+        for code, result in results.items():
+            if result is None:
+                # No answer from Spotify: keep the rows as they were, they are checked again next run
+                failed += 1
+                continue
+            found, album_url = result
+            for index in groups[code]:
+                if found:
+                    frame.at[index, "Spotify"] = "+"
+                    frame.at[index, "Spotify Link"] = album_url
+                else:
+                    frame.at[index, "Spotify"] = "-"
+        if failed:
+            print(f"{failed} lookups got no answer and their rows were left unchanged.")
+
+
+# Ensure 'Spotify' and 'Spotify Link' columns exist, without NaN values
+def add_spotify_columns(releases):
     if "Spotify" not in releases.columns:
         releases["Spotify"] = ""
     if "Spotify Link" not in releases.columns:
@@ -88,66 +484,150 @@ def main(csv_file, client_id, client_secret):
     releases["Spotify"] = releases["Spotify"].fillna("")
     releases["Spotify Link"] = releases["Spotify Link"].fillna("")
 
+
+# Check all releases batch by batch, saving the partial result after each batch
+async def check_releases(releases, upc_column, delimiter, session):
     # Batch processing settings
-    batch_size = 100  # Process 100 rows at a time
+    batch_size = BATCH_SIZE
     total_batches = (len(releases) // batch_size) + 1
 
-    for batch_num in range(total_batches):
-        # Get access token for each batch
-        token = get_spotify_token(client_id, client_secret)
-        start_idx = batch_num * batch_size
-        end_idx = min(start_idx + batch_size, len(releases))
+    async with session:
+        for batch_num in range(total_batches):
+            start_idx = batch_num * batch_size
+            end_idx = min(start_idx + batch_size, len(releases))
+            await session.check_rows(releases, range(start_idx, end_idx), upc_column)
 
-        # Process current batch
-        for index in range(start_idx, end_idx):
-            row = releases.iloc[index]
-            upc = str(row[upc_column])
+            # Save intermediate result
+            releases.to_csv(
+                PARTIAL_FILE,
+                index=False,
+                sep=delimiter,
+            )
+            print(f"Batch {batch_num + 1}/{total_batches} processed and saved ({session.bucket.rate:.1f} requests/s).")
 
-            spotify_status = row["Spotify"]
-            spotify_link = row["Spotify Link"]
 
-            if spotify_status == "+" and spotify_link:
-                # Skip already processed row
-                continue
-            elif spotify_status == "-":
-                # Recheck if release appears on Spotify now
-                found, album_url = search_spotify(upc, token)
-                if found:
-                    releases.at[index, "Spotify"] = "+"
-                    releases.at[index, "Spotify Link"] = album_url
-                # If not found, keep '-'
-            else:
-                # If status is empty, perform a normal check
-                found, album_url = search_spotify(upc, token)
-                if found:
-                    releases.at[index, "Spotify"] = "+"
-                    releases.at[index, "Spotify Link"] = album_url
-                else:
-                    releases.at[index, "Spotify"] = "-"
+# Where a streaming run can resume: {"input": ..., "rows": input rows done, "bytes": output size}
+def load_checkpoint(csv_file):
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(csv_file)
+    if (
+        checkpoint.get("input") != os.path.abspath(csv_file)
+        or checkpoint.get("input_size") != stat.st_size
+        or checkpoint.get("input_mtime_ns") != stat.st_mtime_ns
+        or not os.path.exists(PARTIAL_FILE)
+        or os.path.getsize(PARTIAL_FILE) < checkpoint["bytes"]
+    ):
+        return None
+    return checkpoint
 
-        # Save intermediate result
-        releases.to_csv(
-            "releases_with_spotify_status_partial.csv",
-            index=False,
-            sep=delimiter,
-        )
-        print(f"Batch {batch_num + 1}/{total_batches} processed and saved.")
+
+def save_checkpoint(csv_file, rows, output_bytes):
+    stat = os.stat(csv_file)
+    checkpoint = {
+        "input": os.path.abspath(csv_file),
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "rows": rows,
+        "bytes": output_bytes,
+    }
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+
+# Streaming mode: read the input BATCH_SIZE rows at a time and append each checked chunk to the
+# partial file, so memory stays flat and every row is written once. After each chunk the number of
+# input rows done and the partial file's size are checkpointed; an interrupted run resumes there.
+async def check_releases_streaming(csv_file, delimiter, session):
+    checkpoint = load_checkpoint(csv_file)
+    rows_done = checkpoint["rows"] if checkpoint else 0
+    output_bytes = checkpoint["bytes"] if checkpoint else 0
+    if checkpoint:
+        print(f"Resuming after {rows_done} rows.")
+
+    # Drop whatever was written after the last checkpoint
+    with open(PARTIAL_FILE, "ab") as output:
+        output.truncate(output_bytes)
+
+    to_skip = rows_done
+    async with session:
+        with open(PARTIAL_FILE, "a", encoding="utf-8", newline="") as output:
+            for chunk in load_releases(csv_file, delimiter, chunksize=BATCH_SIZE):
+                if to_skip >= len(chunk):
+                    to_skip -= len(chunk)
+                    continue
+                chunk = chunk.iloc[to_skip:].copy()
+                to_skip = 0
+
+                add_spotify_columns(chunk)
+                # Assume UPC is in the first column
+                await session.check_rows(chunk, chunk.index, chunk.columns[0])
+                chunk.to_csv(output, header=output_bytes == 0, index=False, sep=delimiter)
+
+                output.flush()
+                os.fsync(output.fileno())
+                rows_done += len(chunk)
+                output_bytes = os.fstat(output.fileno()).st_size
+                save_checkpoint(csv_file, rows_done, output_bytes)
+                print(f"{rows_done} rows processed and saved ({session.bucket.rate:.1f} requests/s).")
+
+            if output_bytes == 0:
+                # No rows at all: still write the header, like the non-streaming mode
+                releases = load_releases(csv_file, delimiter)
+                add_spotify_columns(releases)
+                releases.to_csv(output, index=False, sep=delimiter)
+
+    os.replace(PARTIAL_FILE, RESULT_FILE)
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+
+# Main function to execute the process
+def main(csv_file, client_id, client_secret, requests_per_second=REQUESTS_PER_SECOND,
+         max_concurrency=MAX_CONCURRENT_REQUESTS, cache_path=CACHE_PATH, streaming=False):
+    delimiter = detect_delimiter(csv_file)
+    session = LookupSession(client_id, client_secret, requests_per_second, max_concurrency, cache_path)
+
+    if streaming:
+        asyncio.run(check_releases_streaming(csv_file, delimiter, session))
+        print(f"File '{RESULT_FILE}' successfully created.")
+        return
+
+    # The partial file is rewritten from scratch, so a streaming checkpoint no longer applies
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+    # Load releases
+    releases = load_releases(csv_file, delimiter)
+
+    # Assume UPC is in the first column
+    upc_column = releases.columns[0]
+
+    add_spotify_columns(releases)
+
+    asyncio.run(check_releases(releases, upc_column, delimiter, session))
 
     # Save final result
     releases.to_csv(
-        "releases_with_spotify_status.csv",
+        RESULT_FILE,
         index=False,
         sep=delimiter,
     )
-    print("File 'releases_with_spotify_status.csv' successfully created.")
+    print(f"File '{RESULT_FILE}' successfully created.")
 
 
 # Replace these with your own values before running
 client_id = ""  # Spotify Client ID
 client_secret = ""  # Spotify Client Secret
 csv_file = ""  # Path to input CSV file
+streaming = False  # Read and write the CSV in chunks and resume after interruptions (for very large files)
 
 
 # Entry point
 if __name__ == "__main__":
-    main(csv_file, client_id, client_secret)
\ No newline at end of file
+    main(csv_file, client_id, client_secret, streaming=streaming)
\ No newline at end of file
@@ -0,0 +1,349 @@
+from lxml import etree
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import resource
+import tempfile
+from datetime import datetime
+from PIL import Image
+import logging
+
+import local_ddex_packages_converter as converter
+
+# Logging configuration
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+# Version of the JSON result format written by --json
+RESULT_FORMAT_VERSION = 1
+
+ERN_NAMESPACE = 'http://ddex.net/xml/ern/382'
+
+
+def generate_image(image_path, resolution, seed):
+    """Write a noisy JPEG cover of the given resolution (noise keeps the encoded size realistic)."""
+    noise = Image.effect_noise((resolution, resolution), 64 + seed % 32)
+    Image.merge('RGB', (noise, noise.rotate(90), noise.rotate(180))).save(image_path, quality=90)
+
+
+def generate_resource(resource_path, size):
+    """Write a resource file of the given size with incompressible content."""
+    with open(resource_path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 4 * 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def add_nested_details(parent, depth):
+    """Add a chain of nested elements to parent, to push the XML depth of a message."""
+    for level in range(depth):
+        parent = etree.SubElement(parent, 'NestedDetails', Level=str(level))
+    parent.text = 'x'
+
+
+def generate_package_xml(xml_path, upc, audio_files, image_file, xml_depth):
+    """Write a synthetic ERN 3.8.2 NewReleaseMessage referencing the generated resources."""
+    root = etree.Element(f'{{{ERN_NAMESPACE}}}NewReleaseMessage', nsmap={'ern': ERN_NAMESPACE}, MessageSchemaVersionId='ern/382')
+
+    message_header = etree.SubElement(root, 'MessageHeader')
+    etree.SubElement(message_header, 'MessageThreadId').text = upc
+    etree.SubElement(message_header, 'MessageId').text = upc
+    for party in ('MessageSender', 'MessageRecipient'):
+        party_element = etree.SubElement(message_header, party)
+        etree.SubElement(party_element, 'PartyId', Namespace='DPID').text = f'PADPIDA{party}'
+        party_name = etree.SubElement(party_element, 'PartyName')
+        etree.SubElement(party_name, 'FullName').text = f'Synthetic {party}'
+    etree.SubElement(message_header, 'MessageCreatedDateTime').text = '2024-05-17T14:38:20'
+    etree.SubElement(root, 'UpdateIndicator').text = 'OriginalMessage'
+
+    def add_file(parent, file_name):
+        file_element = etree.SubElement(parent, 'File')
+        etree.SubElement(file_element, 'FileName').text = file_name
+        etree.SubElement(file_element, 'FilePath').text = 'resources/'
+        hash_sum = etree.SubElement(file_element, 'HashSum')
+        etree.SubElement(hash_sum, 'HashSum').text = '0' * 32
+        etree.SubElement(hash_sum, 'HashSumAlgorithmType').text = 'MD5'
+
+    resource_list = etree.SubElement(root, 'ResourceList')
+    for index, file_name in enumerate(audio_files, start=1):
+        sound_recording = etree.SubElement(resource_list, 'SoundRecording')
+        etree.SubElement(sound_recording, 'ResourceReference').text = f'A{index}'
+        details = etree.SubElement(sound_recording, 'SoundRecordingDetailsByTerritory')
+        etree.SubElement(details, 'TerritoryCode').text = 'Worldwide'
+        etree.SubElement(details, 'Title', LanguageAndScriptCode='en').text = f' Track {index} '
+        add_nested_details(details, xml_depth)
+        add_file(etree.SubElement(details, 'TechnicalSoundRecordingDetails'), file_name)
+    image = etree.SubElement(resource_list, 'Image')
+    etree.SubElement(image, 'ImageType').text = 'FrontCoverImage'
+    etree.SubElement(image, 'ResourceReference').text = 'A0'
+    add_file(etree.SubElement(etree.SubElement(image, 'ImageDetailsByTerritory'), 'TechnicalImageDetails'), image_file)
+
+    release_list = etree.SubElement(root, 'ReleaseList')
+    release = etree.SubElement(release_list, 'Release')
+    etree.SubElement(etree.SubElement(release, 'ReleaseId'), 'ICPN', IsEan='false').text = upc
+    etree.SubElement(etree.SubElement(release, 'ReferenceTitle'), 'TitleText').text = f'Synthetic release {upc}'
+    add_nested_details(release, xml_depth)
+
+    deal_list = etree.SubElement(root, 'DealList')
+    for index in range(len(audio_files) + 1):
+        release_deal = etree.SubElement(deal_list, 'ReleaseDeal')
+        etree.SubElement(release_deal, 'DealReleaseReference').text = f'R{index}'
+        deal_terms = etree.SubElement(etree.SubElement(release_deal, 'Deal'), 'DealTerms')
+        etree.SubElement(deal_terms, 'TerritoryCode').text = 'Worldwide'
+        etree.SubElement(deal_terms, 'ValidityPeriod').text = '2024-05-17'
+
+    etree.ElementTree(root).write(xml_path, encoding='utf-8', xml_declaration=True, pretty_print=True)
+
+
+def generate_input(input_folder, batches, packages, tracks, resource_size, image_resolution, xml_depth,
+                   shared_artwork=False, seed=0):
+    """Generate a synthetic INPUT tree of batch folders with DDEX packages inside."""
+    rng = random.Random(seed)
+    for batch_index in range(batches):
+        batch_folder = os.path.join(input_folder, f'Batch{20240517000000000 + batch_index}')
+        for package_index in range(packages):
+            upc = f'{4065317900000 + batch_index * packages + package_index:013d}'
+            package_folder = os.path.join(batch_folder, upc)
+            resources_folder = os.path.join(package_folder, 'resources')
+            os.makedirs(resources_folder, exist_ok=True)
+
+            image_file = f'{upc}.jpg'
+            generate_image(
+                os.path.join(resources_folder, image_file),
+                image_resolution,
+                0 if shared_artwork else rng.randrange(1 << 30),
+            )
+            audio_files = [f'{upc}_{track:03d}.flac' for track in range(1, tracks + 1)]
+            for file_name in audio_files:
+                generate_resource(os.path.join(resources_folder, file_name), resource_size)
+            generate_package_xml(os.path.join(package_folder, f'{upc}.xml'), upc, audio_files, image_file, xml_depth)
+
+
+def folder_size(folder):
+    """Total size in bytes of the files below a folder."""
+    return sum(
+        os.path.getsize(os.path.join(dir_path, file_name))
+        for dir_path, _, file_names in os.walk(folder)
+        for file_name in file_names
+    )
+
+
+class StageTimer:
+    """Accumulates wall time, item count and bytes for one benchmark stage."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+
+    def measure(self, function, *args, items=1, size=0, **kwargs):
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds += time.perf_counter() - started
+        self.items += items
+        self.bytes += size
+        return result
+
+    def result(self):
+        return {
+            'seconds': round(self.seconds, 6),
+            'items': self.items,
+            'bytes': self.bytes,
+            'items_per_second': round(self.items / self.seconds, 3) if self.seconds else None,
+            'mb_per_second': round(self.bytes / self.seconds / 1e6, 3) if self.seconds and self.bytes else None,
+        }
+
+
+def write_batch_complete(output_folder, batch_folder, entries):
+    """Write a batch's BatchComplete the way the converter does, through a BatchCompleteWriter."""
+    writer = converter.BatchCompleteWriter(output_folder, batch_folder)
+    for index, entry in enumerate(entries):
+        writer.add(index, entry['package_folder'], entry)
+    writer.finalize()
+
+
+def benchmark_stages(input_folder, work_folder, settings):
+    """Time the converter stages one by one over every generated package.
+
+    Artwork is upscaled first; convert_ddex_structure then finds it in the in-memory artwork cache, so
+    its time is (almost) only the XML work. Resources are copied with the configured transfer
+    strategy and hashed in a separate pass.
+    """
+    stages = {name: StageTimer() for name in ('upscale', 'convert', 'copy_resources', 'hash', 'batch_complete')}
+    output_folder = os.path.join(work_folder, 'STAGES')
+    for batch_folder, package_folders in converter.find_batches(input_folder):
+        entries = []
+        for package_folder in package_folders:
+            package_folder_path = os.path.join(input_folder, batch_folder, package_folder)
+            resources_folder = os.path.join(package_folder_path, 'resources')
+            input_xml_path = os.path.join(package_folder_path, f'{package_folder}.xml')
+            output_folder_path = os.path.join(output_folder, batch_folder, package_folder)
+            os.makedirs(output_folder_path, exist_ok=True)
+
+            for file_name in os.listdir(resources_folder):
+                if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    image_path = os.path.join(resources_folder, file_name)
+                    stages['upscale'].measure(
+                        converter.upscale_image, image_path, settings['artwork_cache_dir'],
+                        size=os.path.getsize(image_path),
+                    )
+
+            xml_entry = stages['convert'].measure(
+                converter.convert_ddex_structure,
+                input_xml_path, os.path.join(output_folder_path, f'{package_folder}.xml'),
+                resources_folder, package_folder, None, None, settings,
+                size=os.path.getsize(input_xml_path),
+            )
+
+            resources_size = folder_size(resources_folder)
+            stages['copy_resources'].measure(
+                converter.copy_resources, resources_folder, os.path.join(output_folder_path, 'resources'),
+                settings['buffer_size'], None, converter.resolve_transfer_strategy(
+                    settings['transfer'], resources_folder, output_folder_path
+                ),
+                size=resources_size,
+            )
+            for dir_path, _, file_names in os.walk(resources_folder):
+                for file_name in file_names:
+                    stages['hash'].measure(
+                        converter.calculate_md5, os.path.join(dir_path, file_name), settings['buffer_size'],
+                        size=os.path.getsize(os.path.join(dir_path, file_name)),
+                    )
+            entries.append({
+                'package_folder': package_folder,
+                'xml_file_name': f'{package_folder}.xml',
+                'message_id': package_folder,
+                'icpn': package_folder,
+                'hash_sum': xml_entry['md5'],
+            })
+        stages['batch_complete'].measure(
+            write_batch_complete, output_folder, batch_folder, entries, items=len(entries)
+        )
+    return {name: timer.result() for name, timer in stages.items()}
+
+
+def benchmark_end_to_end(input_folder, work_folder, settings, workers):
+    """Time a full converter run over the generated INPUT, as main() would do it."""
+    output_folder = os.path.join(work_folder, 'OUTPUT')
+    batches = converter.find_batches(input_folder)
+    timer = StageTimer()
+    packages = sum(len(package_folders) for _, package_folders in batches)
+    if workers > 1:
+        timer.measure(
+            converter.convert_batches_parallel, input_folder, output_folder, batches, workers, settings,
+            items=packages, size=folder_size(input_folder),
+        )
+    else:
+        timer.measure(
+            converter.convert_batches, input_folder, output_folder, batches, settings,
+            items=packages, size=folder_size(input_folder),
+        )
+    return timer.result()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished child processes, in MB."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6, 1),
+    }
+
+
+def compare_results(baseline, results):
+    """Log the change of every stage's time relative to a previous result file."""
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if before and before['seconds'] and stage['seconds']:
+            change = (stage['seconds'] / before['seconds'] - 1) * 100
+            logger.info(f"{name}: {before['seconds']:.3f} s -> {stage['seconds']:.3f} s ({change:+.1f}%)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the DDEX converter on synthetic batches.")
+    parser.add_argument('--batches', type=int, default=1, help="Number of batch folders (default: 1).")
+    parser.add_argument('--packages', type=int, default=20, help="Packages per batch (default: 20).")
+    parser.add_argument('--tracks', type=int, default=12, help="Audio resources per package (default: 12).")
+    parser.add_argument('--resource-size', type=int, default=2 * 1024 * 1024,
+                        help="Size in bytes of each audio resource (default: 2 MiB).")
+    parser.add_argument('--image-resolution', type=int, default=1400,
+                        help="Width and height of the generated cover art (default: 1400).")
+    parser.add_argument('--xml-depth', type=int, default=0,
+                        help="Extra nesting depth added to recordings and releases (default: 0).")
+    parser.add_argument('--shared-artwork', action='store_true',
+                        help="Use the same cover art in every package (exercises the artwork cache).")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the generated data (default: 0).")
+    parser.add_argument('--workers', type=int, default=1, help="Workers for the end-to-end run (default: 1).")
+    parser.add_argument('--transfer', choices=converter.TRANSFER_STRATEGIES, default='copy',
+                        help="Resource transfer strategy (default: copy).")
+    parser.add_argument('--work-dir', default=None,
+                        help="Folder for the generated data and outputs (default: a temporary folder, removed afterwards).")
+    parser.add_argument('--json', default=None, help="Write the results to this JSON file.")
+    parser.add_argument('--compare', default=None, help="Compare the results with a previous JSON result file.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger(converter.__name__).setLevel(logging.WARNING)
+
+    work_folder = args.work_dir or tempfile.mkdtemp(prefix='ddex_benchmark_')
+    try:
+        input_folder = os.path.join(work_folder, 'INPUT')
+        logger.info(f"Generating synthetic input in {input_folder}")
+        started = time.perf_counter()
+        generate_input(
+            input_folder, args.batches, args.packages, args.tracks, args.resource_size,
+            args.image_resolution, args.xml_depth, args.shared_artwork, args.seed,
+        )
+        logger.info(f"Generated {folder_size(input_folder) / 1e6:.1f} MB in {time.perf_counter() - started:.1f} s")
+
+        settings = {**converter.DEFAULT_SETTINGS, 'transfer': args.transfer}
+        results = {
+            'format_version': RESULT_FORMAT_VERSION,
+            'created': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'parameters': {
+                name: getattr(args, name)
+                for name in ('batches', 'packages', 'tracks', 'resource_size', 'image_resolution',
+                             'xml_depth', 'shared_artwork', 'seed', 'workers', 'transfer')
+            },
+            'stages': benchmark_stages(input_folder, work_folder, settings),
+        }
+        # The end-to-end run must not profit from artwork cached by the stage run
+        converter.artwork_cache.clear()
+        results['end_to_end'] = benchmark_end_to_end(input_folder, work_folder, settings, args.workers)
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    for name, stage in [*results['stages'].items(), ('end_to_end', results['end_to_end'])]:
+        logger.info(
+            f"{name}: {stage['seconds']:.3f} s, {stage['items']} items, "
+            f"{stage['items_per_second'] or 0:.1f} items/s, {stage['mb_per_second'] or 0:.1f} MB/s"
+        )
+    logger.info(f"Peak RSS: {results['peak_rss_mb']['self']} MB (workers: {results['peak_rss_mb']['children']} MB)")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
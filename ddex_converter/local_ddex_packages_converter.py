@@ -2,6 +2,31 @@ from lxml import etree
 import os
 import shutil
 import hashlib
+import copy
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import fnmatch
+import argparse
+import json
+import io
+import time
+import threading
+import contextlib
+import tarfile
+import zipfile
+import tempfile
+import cProfile
+import tracemalloc
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from PIL import Image
 import logging
@@ -13,149 +38,1265 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Constants for message sender / recipient
-MESSAGE_SENDER_PARTY_ID = ""
-MESSAGE_SENDER_NAME = ""
 
-def deep_copy_element(source_element, target_element):
-    """Copy the content of source element to target element, preserving the structure."""
-    for sub_element in source_element:
-        new_sub_element = etree.SubElement(target_element, sub_element.tag, sub_element.attrib)
+@dataclass(frozen=True)
+class ConverterConfig:
+    """Party written as message sender and recipient into converted messages and BatchComplete."""
+
+    message_sender_party_id: str = ""
+    message_sender_name: str = ""
+
+
+# Message sender / recipient used unless settings['config'] says otherwise (set your own values here)
+DEFAULT_CONFIG = ConverterConfig(
+    message_sender_party_id="",
+    message_sender_name="",
+)
+
+# Root element and top-level sections of the converted ERN 3.8.2 message
+NEW_RELEASE_MESSAGE_TAG = '{http://ddex.net/xml/ern/382}NewReleaseMessage'
+NEW_RELEASE_MESSAGE_NSMAP = {'ern': 'http://ddex.net/xml/ern/382', 'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+NEW_RELEASE_MESSAGE_ATTRIB = {
+    'LanguageAndScriptCode': 'en',
+    '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation': 'http://ddex.net/xml/ern/382 http://ddex.net/xml/ern/382/release-notification.xsd',
+    'MessageSchemaVersionId': 'ern/382'
+}
+DDEX_SECTIONS = ['MessageHeader', 'UpdateIndicator', 'ResourceList', 'ReleaseList', 'DealList']
+
+# Read/write buffer for copying and hashing files (large enough for multi-hundred-MB WAV/FLAC resources)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Ways of getting a resource file from INPUT to OUTPUT. 'auto' picks reflink (falling back to
+# copy_file_range) when both trees are on the same filesystem, and a hashing copy otherwise.
+TRANSFER_STRATEGIES = ['auto', 'copy', 'hardlink', 'reflink', 'copy_file_range']
+TRANSFER_FALLBACKS = {'reflink': 'copy_file_range', 'copy_file_range': 'copy', 'hardlink': 'copy'}
+
+# Linux ioctl that makes the destination file share the source file's extents (copy-on-write)
+FICLONE = 0x40049409
+
+# Cover art smaller than this (in either dimension) is upscaled to ARTWORK_SIZE x ARTWORK_SIZE
+ARTWORK_SIZE = 3000
+
+# Upscaled artwork kept in memory per process, keyed by source image MD5 and target extension. It is
+# bounded by total bytes, since one 3000x3000 PNG alone is about 19 MB and every worker holds its own
+ARTWORK_CACHE_BYTES = 64 * 1024 * 1024
+artwork_cache = OrderedDict()
+artwork_cache_bytes = 0
+artwork_cache_lock = threading.Lock()
+
+# Version of the incremental package cache records; bump it when the converter output changes
+PACKAGE_CACHE_VERSION = 3
+
+# Package descriptors of the last discovery, kept in the cache folder with --incremental; bump the
+# version when PackageDescriptor changes
+DISCOVERY_CACHE_FILE = 'discovery.json'
+DISCOVERY_CACHE_VERSION = 1
+
+# Settings used when a caller does not pass its own (see parse_args for their meaning)
+DEFAULT_SETTINGS = {
+    'streaming': False,
+    'buffer_size': COPY_BUFFER_SIZE,
+    'transfer': 'auto',
+    'incremental': False,
+    'cache_dir': './.ddex_cache',
+    'artwork_threads': 4,
+    'artwork_cache_dir': None,
+    'journal': True,
+    'report': False,
+    'profile': None,
+    'profile_dir': './ddex_profiles',
+    'output_format': 'directory',
+    'config': DEFAULT_CONFIG,
+    'xsd': None,
+    'memory_budget': None,
+    'io_budget': None,
+}
+
+# Admission control for --workers: a package's peak memory is estimated from its XML size (a parsed
+# lxml tree takes several times the file size, a streamed one only its largest section) and its image
+# files (an upscale holds the decoded source and the ARTWORK_SIZE bitmap), plus a fixed overhead
+XML_MEMORY_FACTOR = 10
+STREAMING_XML_MEMORY_FACTOR = 2
+ARTWORK_MEMORY = ARTWORK_SIZE * ARTWORK_SIZE * 4 * 2
+PACKAGE_BASE_MEMORY = 32 * 1024 * 1024
+
+# Instrumentation (--report, --profile): stage timings, counters and byte totals of the package this
+# process is converting. It is None while instrumentation is off, so every hook costs one global lookup.
+package_stats = None
+package_stats_lock = threading.Lock()
+NO_STAGE = contextlib.nullcontext()
+
+# Allocation sites listed per package by --profile tracemalloc, and stages named in summary log lines
+TRACEMALLOC_TOP_LINES = 10
+LOGGED_STAGES = 6
+
+# Watch mode: a package is converted once its files have not changed for WATCH_SETTLE_SECONDS
+# (or as soon as a ready marker appears); without inotify, folders are polled every WATCH_POLL_INTERVAL
+WATCH_SETTLE_SECONDS = 10.0
+WATCH_POLL_INTERVAL = 2.0
+
+# Linux inotify event bits (sys/inotify.h) used by watch mode, and the fixed part of an event record
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Where converted batches go: a folder tree (default), or one streamed archive per batch
+OUTPUT_FORMATS = ['directory', 'tar', 'zip']
+
+# --xsd: compiled schemas, loaded once per process and keyed by XSD path, and how many errors are
+# logged per invalid message (all of them are counted)
+xml_schemas = {}
+xml_schemas_lock = threading.Lock()
+VALIDATION_ERRORS_LOGGED = 10
+
+# Parser for source messages: whitespace-only text between elements is dropped while parsing
+SOURCE_PARSER = etree.XMLParser(remove_blank_text=True)
+
+# Text nodes that still need stripping after a blank-text-free parse, and nodes the output never keeps
+UNSTRIPPED_TEXT_XPATH = etree.XPath('.//text()[normalize-space(.) != .]')
+NON_ELEMENT_XPATH = etree.XPath('.//comment() | .//processing-instruction()')
+
+# Namespaced element and attribute names in a section, whose output prefixes a deepcopy may not reproduce
+NAMESPACED_NAMES_XPATH = etree.XPath(
+    'descendant::*[namespace-uri() != ""] | descendant-or-self::*/@*[namespace-uri() != ""]'
+)
+
+
+class StageTimer:
+    """Adds the wall time of a with-block to one stage of the current package's stats."""
+
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        with package_stats_lock:
+            if package_stats is not None:
+                stage = package_stats['stages'].setdefault(self.stage, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += elapsed
+                stage['calls'] += 1
+
+
+def timed(stage):
+    """Time a with-block as a stage of the current package; a shared no-op while instrumentation is off."""
+    return NO_STAGE if package_stats is None else StageTimer(stage)
+
+
+def count(counter, amount=1):
+    """Add to a counter of the current package, e.g. 'bytes_read'; a no-op while instrumentation is off."""
+    if package_stats is not None:
+        with package_stats_lock:
+            package_stats['counters'][counter] = package_stats['counters'].get(counter, 0) + amount
+
+
+def keeps_namespace_prefixes(source_element, nsmap):
+    """Whether every namespaced name in the section uses the prefix nsmap (the output parent's) declares for it."""
+    for name in NAMESPACED_NAMES_XPATH(source_element):
+        if isinstance(name, etree._Element):
+            uri, prefixes = etree.QName(name).namespace, [name.prefix]
+        else:
+            uri = etree.QName(name.attrname).namespace
+            prefixes = [prefix for prefix, value in name.getparent().nsmap.items() if value == uri]
+        if len(prefixes) != 1 or prefixes[0] is None or nsmap.get(prefixes[0]) != uri:
+            return False
+    return True
+
+
+def copy_section_nodes(source_element, new_element):
+    """Copy a section's children into new_element element by element, in document order.
+
+    lxml names a namespace the output does not declare yet ns0, ns1, ... on the first element that
+    needs it, so this reproduces the prefixes the original converter wrote.
+    """
+    stack = [(iter(source_element), new_element)]
+    while stack:
+        sub_element = next(stack[-1][0], None)
+        if sub_element is None:
+            stack.pop()
+            continue
+        if not isinstance(sub_element.tag, str):
+            continue
+        new_sub_element = etree.SubElement(stack[-1][1], sub_element.tag, sub_element.attrib)
         if sub_element.text and sub_element.text.strip():
             new_sub_element.text = sub_element.text.strip()
-        deep_copy_element(sub_element, new_sub_element)
         if sub_element.tail and sub_element.tail.strip():
             new_sub_element.tail = sub_element.tail.strip()
+        stack.append((iter(sub_element), new_sub_element))
+
+
+def transplant_section(source_element, section, parent=None):
+    """Copy a top-level section subtree natively and normalise it for the output message.
+
+    The subtree is copied in one deepcopy call (C speed, no Python recursion) and renamed to the
+    unqualified section tag. The source is parsed with SOURCE_PARSER, so whitespace-only text between
+    elements is already gone; the remaining clean-up only visits the text nodes that still have
+    surrounding whitespace, plus any comments and processing instructions, which are removed.
+    As with the previous node-by-node copy, the section's own text is not kept. The copy is
+    appended to parent if given.
+
+    A deepcopy keeps the source's namespace prefixes, so a section with namespaced names the
+    output parent does not declare under the same prefix is copied node by node instead.
+    """
+    if not keeps_namespace_prefixes(source_element, {} if parent is None else parent.nsmap):
+        if parent is None:
+            new_element = etree.Element(section, source_element.attrib)
+        else:
+            new_element = etree.SubElement(parent, section, source_element.attrib)
+        copy_section_nodes(source_element, new_element)
+        return new_element
+
+    new_element = copy.deepcopy(source_element)
+    new_element.tag = section
+    new_element.text = None
+    new_element.tail = None
+    for node in NON_ELEMENT_XPATH(new_element):
+        node.getparent().remove(node)
+    for text in UNSTRIPPED_TEXT_XPATH(new_element):
+        owner = text.getparent()
+        if text.is_tail:
+            owner.tail = text.strip() or None
+        elif owner is not new_element:
+            owner.text = text.strip() or None
+    if parent is not None:
+        parent.append(new_element)
+    return new_element
+
 
+# Rewrite rules for the converted message, keyed by element tag. All of them run during one
+# traversal of the tree (see apply_rewrites), so a new rule does not add another full tree walk.
+REWRITE_HANDLERS = {}
 
-def update_message_recipient(root):
+# Lookups used inside matched elements, compiled once
+FIRST_PARTY_ID_XPATH = etree.XPath('(descendant::PartyId)[1]')
+FIRST_PARTY_NAME_XPATH = etree.XPath('(descendant::PartyName)[1]')
+FIRST_FULL_NAME_XPATH = etree.XPath('(descendant::FullName)[1]')
+
+
+def rewrite_handler(tag):
+    """Register the decorated function as the rewrite rule for elements with the given tag."""
+    def register(handler):
+        REWRITE_HANDLERS[tag] = handler
+        return handler
+    return register
+
+
+def apply_rewrites(root, context):
+    """Apply every registered rewrite rule to the tree in a single traversal.
+
+    context is a dict with the per-package data the rules need ('resources', 'ean_upc_code', 'config').
+    """
+    for element in list(root.iter(*REWRITE_HANDLERS)):
+        REWRITE_HANDLERS[element.tag](element, context)
+
+
+@rewrite_handler('MessageRecipient')
+def update_message_recipient(message_recipient_element, context):
     """Update the MessageRecipient section with the new data."""
-    for message_recipient_element in root.xpath('//MessageRecipient'):
-        party_id_element = message_recipient_element.find('.//PartyId')
-        if party_id_element is not None:
-            party_id_element.text = MESSAGE_SENDER_PARTY_ID
-            if 'Namespace' in party_id_element.attrib:
-                del party_id_element.attrib['Namespace']
-        
-        party_name_element = message_recipient_element.find('.//PartyName')
-        if party_name_element is not None:
-            full_name_element = party_name_element.find('.//FullName')
-            if full_name_element is not None:
-                full_name_element.text = MESSAGE_SENDER_NAME
-
-
-def update_icpn(root, ean_upc_code):
+    party_id_elements = FIRST_PARTY_ID_XPATH(message_recipient_element)
+    if party_id_elements:
+        party_id_element = party_id_elements[0]
+        party_id_element.text = context['config'].message_sender_party_id
+        if 'Namespace' in party_id_element.attrib:
+            del party_id_element.attrib['Namespace']
+
+    party_name_elements = FIRST_PARTY_NAME_XPATH(message_recipient_element)
+    if party_name_elements:
+        full_name_elements = FIRST_FULL_NAME_XPATH(party_name_elements[0])
+        if full_name_elements:
+            full_name_elements[0].text = context['config'].message_sender_name
+
+
+@rewrite_handler('ICPN')
+def update_icpn(icpn_element, context):
     """Update the ICPN section with new data."""
-    for icpn_element in root.xpath('//ICPN'):
-        if icpn_element.text:
-            icpn_element.set('IsEan', 'true')
-            icpn_element.text = ean_upc_code
+    if icpn_element.text:
+        icpn_element.set('IsEan', 'true')
+        icpn_element.text = context['ean_upc_code']
+
+
+def probe_image_size(image_file):
+    """Return (width, height) of an image file or binary file object.
+
+    Only the file header is read, the pixels are not decoded.
+    """
+    with Image.open(image_file) as img:
+        return img.size
+
+
+def load_cached_artwork(cache_key, cache_dir):
+    """Return upscaled artwork from the in-memory cache or the on-disk cache folder, or None."""
+    with artwork_cache_lock:
+        if cache_key in artwork_cache:
+            artwork_cache.move_to_end(cache_key)
+            return artwork_cache[cache_key]
+    if cache_dir:
+        try:
+            with open(os.path.join(cache_dir, cache_key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    return None
 
 
-def upscale_image(image_path):
-    """Upscale image to 3000x3000 if it's smaller."""
+def store_cached_artwork(cache_key, cache_dir, image_data):
+    """Put upscaled artwork into the in-memory cache and, if configured, the on-disk cache folder.
+
+    The least recently used entries are evicted until the cache fits ARTWORK_CACHE_BYTES again;
+    artwork bigger than the whole budget is not kept in memory.
+    """
+    global artwork_cache_bytes
+    with artwork_cache_lock:
+        if cache_key not in artwork_cache and len(image_data) <= ARTWORK_CACHE_BYTES:
+            artwork_cache[cache_key] = image_data
+            artwork_cache_bytes += len(image_data)
+            while artwork_cache_bytes > ARTWORK_CACHE_BYTES:
+                artwork_cache_bytes -= len(artwork_cache.popitem(last=False)[1])
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, cache_key)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(image_data)
+        os.replace(tmp_path, cache_path)
+
+
+def upscale_image(image_path, cache_dir=None, resources=None):
+    """Upscale image to 3000x3000 if it's smaller; returns the encoded image, or None if it is kept as is.
+
+    image_path is a file path or, if resources (a ResourceProvider) is given, a file name in it.
+    """
+    if resources is None:
+        resources = FolderResources(os.path.dirname(image_path))
+        image_path = os.path.basename(image_path)
+    image_label = resources.path(image_path) or image_path
+    started = time.perf_counter()
     try:
-        with Image.open(image_path) as img:
-            if img.width < 3000 or img.height < 3000:
-                img = img.resize((3000, 3000), Image.LANCZOS)
-                img.save(image_path)
-                logger.info(f"Upscaled image saved at: {image_path}")
+        with timed('artwork_probe'), resources.open(image_path) as f:
+            width, height = probe_image_size(f)
+        if width >= ARTWORK_SIZE and height >= ARTWORK_SIZE:
+            count('artwork_kept')
+            logger.info(
+                f"Artwork {image_label} is {width}x{height}, kept as is "
+                f"({(time.perf_counter() - started) * 1000:.1f} ms)"
+            )
+            return None
+
+        with resources.open(image_path) as f:
+            source_data = f.read()
+        count('bytes_read', len(source_data))
+        extension = os.path.splitext(image_path)[1].lower()
+        cache_key = f"{hashlib.md5(source_data).hexdigest()}_{ARTWORK_SIZE}{extension}"
+        image_data = load_cached_artwork(cache_key, cache_dir)
+        cache_hit = image_data is not None
+        if cache_hit:
+            count('artwork_cache_hits')
+        else:
+            with timed('artwork_resize'):
+                output = io.BytesIO()
+                with Image.open(io.BytesIO(source_data)) as img:
+                    img = img.resize((ARTWORK_SIZE, ARTWORK_SIZE), Image.LANCZOS)
+                    img.save(output, format=Image.registered_extensions()[extension])
+                image_data = output.getvalue()
+            count('artwork_resized')
+            store_cached_artwork(cache_key, cache_dir, image_data)
+
+        logger.info(
+            f"Upscaled image {image_label} ({width}x{height} -> {ARTWORK_SIZE}x{ARTWORK_SIZE}, "
+            f"{'cache hit' if cache_hit else 'resized'} in {(time.perf_counter() - started) * 1000:.1f} ms)"
+        )
+        return image_data
     except Exception as e:
-        logger.error(f"Error upscaling image {image_path}: {e}")
+        logger.error(f"Error upscaling image {image_label}: {e}")
+        return None
 
 
-def calculate_md5(file_path):
+def calculate_md5(file_path, buffer_size=COPY_BUFFER_SIZE):
     """Calculate the MD5 hash of a file."""
     hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with timed('hash'), open(file_path, "rb", buffering=0) as f:
+        for chunk in iter(lambda: f.read(buffer_size), b""):
             hash_md5.update(chunk)
+        count('bytes_read', f.tell())
     return hash_md5.hexdigest()
 
 
-def update_image_metadata_and_hash(root, resources_folder):
-    """Update image metadata and hash for upscaled images."""
-    for file_element in root.xpath('//File'):
-        file_name_element = file_element.find('FileName')
-        file_path_element = file_element.find('FilePath')
-        if file_name_element is not None and file_path_element is not None:
-            image_path = os.path.join(resources_folder, file_name_element.text)
-            if os.path.exists(image_path):
-                if image_path.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    upscale_image(image_path)
-                    new_hash = calculate_md5(image_path)
-                    hash_sum_element = file_element.find('HashSum/HashSum')
-                    if hash_sum_element is not None:
-                        hash_sum_element.text = new_hash
-
-
-def convert_ddex_structure(input_xml_path, output_xml_path, resources_folder, ean_upc_code):
-    """Convert the structure of the DDEX XML."""
-    if not os.path.exists(input_xml_path) or os.path.getsize(input_xml_path) == 0:
-        logger.error(f"The file {input_xml_path} does not exist or is empty.")
+def copy_and_hash_file(src_path, dst_path, buffer_size=COPY_BUFFER_SIZE):
+    """Copy a file with its metadata, calculating its MD5 from the same reads.
+
+    Returns the manifest entry {'size': ..., 'md5': ...} of the file.
+    """
+    hash_md5 = hashlib.md5()
+    size = 0
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with timed('copy'), open(src_path, 'rb', buffering=0) as src, open(dst_path, 'wb', buffering=0) as dst:
+        while True:
+            length = src.readinto(buffer)
+            if not length:
+                break
+            chunk = view[:length]
+            hash_md5.update(chunk)
+            dst.write(chunk)
+            size += length
+    shutil.copystat(src_path, dst_path)
+    count('bytes_read', size)
+    count('bytes_written', size)
+    return {'size': size, 'md5': hash_md5.hexdigest()}
+
+
+def copy_and_hash_resource(resources, name, sink, dst_path, buffer_size=COPY_BUFFER_SIZE):
+    """Copy a resource that has no filesystem path through sink.open, calculating its MD5 on the way.
+
+    Returns the manifest entry {'size': ..., 'md5': ...} of the output file.
+    """
+    hash_md5 = hashlib.md5()
+    size = 0
+    with timed('copy'), resources.open(name) as src, sink.open(dst_path) as dst:
+        for chunk in iter(lambda: src.read(buffer_size), b""):
+            hash_md5.update(chunk)
+            dst.write(chunk)
+            size += len(chunk)
+    count('bytes_read', size)
+    if sink.writes_folder_tree:
+        count('bytes_written', size)
+    return {'size': size, 'md5': hash_md5.hexdigest()}
+
+
+def reflink_file(src_path, dst_path):
+    """Clone a file with the FICLONE ioctl (btrfs, XFS, ...); data blocks are shared until modified."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(src_path, dst_path)
+
+
+def kernel_copy_file(src_path, dst_path):
+    """Copy a file inside the kernel with copy_file_range, or sendfile where that is not supported."""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        while offset < size:
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                os.lseek(dst.fileno(), offset, os.SEEK_SET)
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+    shutil.copystat(src_path, dst_path)
+
+
+def resolve_transfer_strategy(strategy, src_folder, dst_folder):
+    """Turn the 'auto' transfer strategy into a concrete one for a source/destination folder pair."""
+    if strategy != 'auto':
+        return strategy
+    if os.stat(src_folder).st_dev == os.stat(dst_folder).st_dev:
+        return 'reflink'
+    return 'copy'
+
+
+def transfer_file(src_path, dst_path, strategy='copy', buffer_size=COPY_BUFFER_SIZE):
+    """Transfer one resource file to the output with the given strategy.
+
+    Returns the manifest entry of the file. Only the 'copy' strategy reads the data in user space, so
+    the other strategies leave 'md5' as None. A strategy the filesystem does not support falls back
+    along TRANSFER_FALLBACKS, ending with a plain copy.
+    """
+    while strategy != 'copy':
+        try:
+            with timed(strategy):
+                if strategy == 'hardlink':
+                    os.link(src_path, dst_path)
+                elif strategy == 'reflink':
+                    reflink_file(src_path, dst_path)
+                else:
+                    kernel_copy_file(src_path, dst_path)
+            size = os.path.getsize(dst_path)
+            count(f'{strategy}_bytes', size)
+            return {'size': size, 'md5': None}
+        except OSError as e:
+            if not os.path.exists(src_path):
+                raise
+            logger.debug(f"Transfer strategy {strategy} failed for {src_path}: {e}")
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            strategy = TRANSFER_FALLBACKS[strategy]
+    return copy_and_hash_file(src_path, dst_path, buffer_size)
+
+
+class HashingWriter:
+    """Write-only file wrapper that calculates the size and MD5 of everything written through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash_md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.hash_md5.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def manifest_entry(self):
+        return {'size': self.size, 'md5': self.hash_md5.hexdigest()}
+
+
+class HashingReader:
+    """Read-only file wrapper that calculates the size and MD5 of everything read through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash_md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hash_md5.update(data)
+        self.size += len(data)
+        return data
+
+    def manifest_entry(self):
+        return {'size': self.size, 'md5': self.hash_md5.hexdigest()}
+
+
+class ResourceProvider(ABC):
+    """Where the resource files of a package are read from, by their path relative to the resources folder.
+
+    Subclasses implement open(), exists() and size(). path() is the file's filesystem path, or None
+    if it has none; only resources with a path can use the --transfer strategies, the others are
+    streamed from open() into the output.
+    """
+
+    @abstractmethod
+    def open(self, name):
+        """Open a resource for binary reading."""
+
+    @abstractmethod
+    def exists(self, name):
+        pass
+
+    @abstractmethod
+    def size(self, name):
+        pass
+
+    def path(self, name):
+        return None
+
+    def md5(self, name, buffer_size=COPY_BUFFER_SIZE):
+        hash_md5 = hashlib.md5()
+        with timed('hash'), self.open(name) as f:
+            for chunk in iter(lambda: f.read(buffer_size), b""):
+                hash_md5.update(chunk)
+        return hash_md5.hexdigest()
+
+
+class FolderResources(ResourceProvider):
+    """Resources in a package's resources folder (what the command line converter uses)."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def md5(self, name, buffer_size=COPY_BUFFER_SIZE):
+        return calculate_md5(self.path(name), buffer_size)
+
+
+class MemoryResources(ResourceProvider):
+    """Resources held in memory as {file name: bytes}."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def open(self, name):
+        return io.BytesIO(self.files[name])
+
+    def exists(self, name):
+        return name in self.files
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def md5(self, name, buffer_size=COPY_BUFFER_SIZE):
+        with timed('hash'):
+            return hashlib.md5(self.files[name]).hexdigest()
+
+
+class OutputSink(ABC):
+    """Where converted packages are written: DirectorySink, the ArchiveSink subclasses or MemorySink.
+
+    Every sink takes the paths the files would have in the OUTPUT tree; the archive sinks turn them
+    into member names. Writes return the manifest entry {'size': ..., 'md5': ...} of the output file.
+    Only a sink that writes_folder_tree leaves output folders that --incremental, the batch journal
+    and the --transfer strategies can work with.
+    """
+
+    writes_folder_tree = False
+    archive_path = None
+    failed = False  # set by archive sinks once their archive can no longer be completed
+
+    @abstractmethod
+    def make_folder(self, folder):
+        pass
+
+    @abstractmethod
+    def reset_folder(self, folder):
+        """Remove what a previous run left in a package's output folder."""
+
+    @abstractmethod
+    def write_bytes(self, path, data):
+        pass
+
+    @abstractmethod
+    def transfer(self, src_path, path, strategy='copy', buffer_size=COPY_BUFFER_SIZE):
+        """Write the resource file at src_path to path, with the --transfer strategy where it applies."""
+
+    @abstractmethod
+    def open(self, path):
+        """Open a file to be written piecewise (the streaming XML engine); see discard."""
+
+    @abstractmethod
+    def discard(self, path):
+        """Drop a file opened with open() whose content turned out to be unusable."""
+
+    def local_path(self, path):
+        """Where to keep a working file (e.g. the BatchComplete .partial) that belongs next to path."""
+        return path
+
+    def commit(self, local_path, path):
+        """Move a finished working file from local_path to its output path."""
+        os.replace(local_path, path)
+
+    def close(self):
+        pass
+
+
+class DirectorySink(OutputSink):
+    """Output sink that writes converted packages as files in the OUTPUT folder tree (the default)."""
+
+    writes_folder_tree = True
+
+    def make_folder(self, folder):
+        os.makedirs(folder, exist_ok=True)
+
+    def reset_folder(self, folder):
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder, exist_ok=True)
+
+    def write_bytes(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+        count('bytes_written', len(data))
+        return {'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+
+    def transfer(self, src_path, path, strategy='copy', buffer_size=COPY_BUFFER_SIZE):
+        return transfer_file(src_path, path, strategy, buffer_size)
+
+    def open(self, path):
+        return open(path, 'wb')
+
+    def discard(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ArchiveMemberWriter:
+    """File-like object from ArchiveSink.open: spools the data and adds it as a member when closed
+    without an exception (tar needs the member size up front, and a half-written zip member cannot
+    be taken back)."""
+
+    def __init__(self, sink, path):
+        self.sink = sink
+        self.path = path
+        self.spool = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, dir=sink.scratch_folder)
+
+    def write(self, data):
+        return self.spool.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            size = self.spool.tell()
+            self.spool.seek(0)
+            self.sink.add_member(self.path, self.spool, size, time.time())
+        self.spool.close()
+
+
+class ArchiveSink(OutputSink):
+    """Base of the sinks that stream a whole batch into one archive, <OUTPUT>/<batch><extension>.
+
+    Members are named like the files of the OUTPUT tree (<batch>/<package>/...), so unpacking the
+    archive gives the same tree as the directory sink. Data is hashed while it is streamed in, so
+    every resource is read once and written once. The archive is written as <name>.part and renamed
+    when the batch is closed; working files (the BatchComplete records) live in a scratch folder.
+    """
+
+    extension = None
+
+    def __init__(self, output_folder, batch_folder, buffer_size=COPY_BUFFER_SIZE):
+        os.makedirs(output_folder, exist_ok=True)
+        self.output_folder = output_folder
+        self.buffer_size = buffer_size
+        self.archive_path = os.path.join(output_folder, f"{batch_folder}{self.extension}")
+        self.part_path = f"{self.archive_path}.part"
+        self.scratch_folder = tempfile.mkdtemp(prefix=f".{batch_folder}.", dir=output_folder)
+        self.failed = False
+
+    def member_name(self, path):
+        return os.path.relpath(path, self.output_folder).replace(os.sep, '/')
+
+    @abstractmethod
+    def add_member(self, path, fileobj, size, mtime):
+        """Stream size bytes from fileobj into the archive as the member for path."""
+
+    @abstractmethod
+    def close_archive(self):
+        """Write the archive's end (index, trailer) and close the .part file."""
+
+    def add(self, path, fileobj, size, mtime):
+        try:
+            with timed('archive'):
+                self.add_member(path, fileobj, size, mtime)
+        except Exception:
+            # A member that failed halfway leaves the archive stream unusable
+            self.failed = True
+            raise
+        count('bytes_written', size)
+
+    def make_folder(self, folder):
+        pass
+
+    def reset_folder(self, folder):
+        pass
+
+    def write_bytes(self, path, data):
+        self.add(path, io.BytesIO(data), len(data), time.time())
+        return {'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+
+    def transfer(self, src_path, path, strategy='copy', buffer_size=COPY_BUFFER_SIZE):
+        """Stream a resource into the archive, hashing it on the way (the transfer strategy does not apply)."""
+        with open(src_path, 'rb', buffering=0) as src:
+            stat = os.fstat(src.fileno())
+            reader = HashingReader(src)
+            self.add(path, reader, stat.st_size, stat.st_mtime)
+        count('bytes_read', reader.size)
+        return reader.manifest_entry()
+
+    def open(self, path):
+        return ArchiveMemberWriter(self, path)
+
+    def discard(self, path):
+        pass
+
+    def local_path(self, path):
+        local_path = os.path.join(self.scratch_folder, os.path.relpath(path, self.output_folder))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return local_path
+
+    def commit(self, local_path, path):
+        with open(local_path, 'rb') as f:
+            self.add(path, f, os.fstat(f.fileno()).st_size, time.time())
+        os.remove(local_path)
+
+    def close(self):
+        """Finish the archive and move it into place, or drop it if a member could not be written."""
+        self.close_archive()
+        shutil.rmtree(self.scratch_folder, ignore_errors=True)
+        if self.failed:
+            logger.error(f"Writing {self.archive_path} failed, the incomplete archive was removed.")
+            os.remove(self.part_path)
+        else:
+            os.replace(self.part_path, self.archive_path)
+
+
+class TarSink(ArchiveSink):
+    """Streams a batch into an uncompressed tar (written front to back, so it could go to a pipe)."""
+
+    extension = '.tar'
+
+    def __init__(self, output_folder, batch_folder, buffer_size=COPY_BUFFER_SIZE):
+        super().__init__(output_folder, batch_folder, buffer_size)
+        self.tar = tarfile.open(self.part_path, 'w|', bufsize=buffer_size, format=tarfile.PAX_FORMAT)
+        self.tar.copybufsize = buffer_size
+
+    def add_member(self, path, fileobj, size, mtime):
+        info = tarfile.TarInfo(self.member_name(path))
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        self.tar.addfile(info, fileobj)
+
+    def close_archive(self):
+        self.tar.close()
+
+
+class ZipSink(ArchiveSink):
+    """Streams a batch into a zip. Members are stored uncompressed: audio and artwork do not compress."""
+
+    extension = '.zip'
+
+    def __init__(self, output_folder, batch_folder, buffer_size=COPY_BUFFER_SIZE):
+        super().__init__(output_folder, batch_folder, buffer_size)
+        self.zip = zipfile.ZipFile(self.part_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_member(self, path, fileobj, size, mtime):
+        info = zipfile.ZipInfo(self.member_name(path), date_time=time.localtime(max(mtime, 315532800))[:6])
+        info.external_attr = 0o644 << 16  # rw-r--r--, like the tar and directory output
+        with self.zip.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+            while True:
+                data = fileobj.read(self.buffer_size)
+                if not data:
+                    break
+                member.write(data)
+
+    def close_archive(self):
+        self.zip.close()
+
+
+class MemoryFile(io.BytesIO):
+    """In-memory file of a MemorySink; its content is stored in the sink when it is closed."""
+
+    def __init__(self, files, path):
+        super().__init__()
+        self.files = files
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.files[self.path] = self.getvalue()
+        super().close()
+
+
+class MemorySink(OutputSink):
+    """Output sink that keeps the written files in memory as {path: bytes} (see convert_ddex_message).
+
+    Folders are not created. Meant for single messages: BatchComplete still goes through the disk.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def make_folder(self, folder):
+        pass
+
+    def reset_folder(self, folder):
+        prefix = os.path.join(folder, '')
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            del self.files[path]
+
+    def write_bytes(self, path, data):
+        self.files[path] = bytes(data)
+        return {'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+
+    def transfer(self, src_path, path, strategy='copy', buffer_size=COPY_BUFFER_SIZE):
+        with open(src_path, 'rb') as f:
+            count('bytes_read', os.fstat(f.fileno()).st_size)
+            return self.write_bytes(path, f.read())
+
+    def open(self, path):
+        return MemoryFile(self.files, path)
+
+    def discard(self, path):
+        self.files.pop(path, None)
+
+
+def open_sink(output_format, output_folder, batch_folder, buffer_size=COPY_BUFFER_SIZE):
+    """Create the output sink of one batch for an OUTPUT_FORMATS value."""
+    if output_format == 'tar':
+        return TarSink(output_folder, batch_folder, buffer_size)
+    if output_format == 'zip':
+        return ZipSink(output_folder, batch_folder, buffer_size)
+    return DirectorySink()
+
+
+def resource_name(file_name):
+    """Return a FileName as the normalized path copy_resources uses, or None if it points outside resources/."""
+    if not file_name:
+        return None
+    name = os.path.normpath(file_name)
+    if os.path.isabs(name) or name == os.pardir or name.startswith(os.pardir + os.sep):
+        return None
+    return name
+
+
+def hash_resource(context, file_name):
+    """Return the MD5 of a package resource, recording it in the package manifest.
+
+    When the package has an output resources folder the file is transferred there first (with a
+    'copy' transfer the hash comes from the same pass), so copy_resources does not touch it again.
+    """
+    manifest = context['manifest']
+    settings = context['settings']
+    resources = context['resources']
+    if file_name not in manifest:
+        dst_resources = context['dst_resources']
+        if dst_resources:
+            dst_path = os.path.join(dst_resources, file_name)
+            context['sink'].make_folder(os.path.dirname(dst_path))
+            if resources.path(file_name) is None:
+                manifest[file_name] = copy_and_hash_resource(
+                    resources, file_name, context['sink'], dst_path, settings['buffer_size']
+                )
+            else:
+                manifest[file_name] = context['sink'].transfer(
+                    resources.path(file_name), dst_path, settings['transfer'], settings['buffer_size']
+                )
+        else:
+            manifest[file_name] = {'size': resources.size(file_name), 'md5': None}
+    if manifest[file_name]['md5'] is None:
+        manifest[file_name]['md5'] = resources.md5(file_name, settings['buffer_size'])
+    return manifest[file_name]['md5']
+
+
+@rewrite_handler('File')
+def update_image_metadata_and_hash(file_element, context):
+    """Queue the image a File element points to for the artwork stage (see process_artwork)."""
+    file_name_element = file_element.find('FileName')
+    file_path_element = file_element.find('FilePath')
+    if file_name_element is not None and file_path_element is not None:
+        file_name = resource_name(file_name_element.text)
+        if file_name is None:
+            logger.warning(f"Ignoring FileName outside the resources folder: {file_name_element.text}")
+        elif context['resources'].exists(file_name):
+            if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                context['artwork'].append((file_element, file_name))
+
+
+def process_artwork(context):
+    """Upscale and hash the artwork queued by the rewrites, then update the HashSum of its File elements."""
+    jobs, context['artwork'] = context['artwork'], []
+    if not jobs:
+        return
+    settings = context['settings']
+
+    def prepare(file_name):
+        image_data = upscale_image(file_name, settings['artwork_cache_dir'], context['resources'])
+        if image_data is None:
+            return file_name, hash_resource(context, file_name)
+
+        dst_resources = context['dst_resources']
+        if dst_resources:
+            dst_path = os.path.join(dst_resources, file_name)
+            context['sink'].make_folder(os.path.dirname(dst_path))
+            entry = context['sink'].write_bytes(dst_path, image_data)
+            logger.info(f"Upscaled image saved at: {dst_path}")
+        else:
+            entry = {'size': len(image_data), 'md5': hashlib.md5(image_data).hexdigest()}
+            context['processed_artwork'][file_name] = image_data
+        context['manifest'][file_name] = entry
+        return file_name, entry['md5']
+
+    file_names = list(dict.fromkeys(file_name for _, file_name in jobs))
+    with timed('artwork'), ThreadPoolExecutor(max_workers=max(1, settings['artwork_threads'])) as executor:
+        new_hashes = dict(executor.map(prepare, file_names))
+
+    for file_element, file_name in jobs:
+        hash_sum_element = file_element.find('HashSum/HashSum')
+        if hash_sum_element is not None:
+            hash_sum_element.text = new_hashes[file_name]
+
+
+def load_schema(xsd_path):
+    """Return the compiled XMLSchema of an XSD file, parsing it (and the schemas it imports) only once per process."""
+    xsd_path = os.path.abspath(xsd_path)
+    with xml_schemas_lock:
+        if xsd_path not in xml_schemas:
+            started = time.perf_counter()
+            xml_schemas[xsd_path] = etree.XMLSchema(etree.parse(xsd_path))
+            logger.info(f"Loaded XML schema {xsd_path} in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return xml_schemas[xsd_path]
+
+
+def validate_message(root, xsd_path, name):
+    """Validate a converted message tree against the XSD; invalid messages are logged. Returns whether it is valid."""
+    schema = load_schema(xsd_path)
+    with xml_schemas_lock:
+        valid = schema.validate(root)
+        errors = list(schema.error_log)
+    if not valid:
+        count('validation_errors', len(errors))
+        logger.error(f"{name} is not valid against {xsd_path} ({len(errors)} errors):")
+        for error in errors[:VALIDATION_ERRORS_LOGGED]:
+            logger.error(f"  {error.path}: {error.message}")
+    return valid
+
+
+def make_rewrite_context(resources_folder, ean_upc_code, dst_resources, manifest, settings, sink=None, artwork=None):
+    """Build the context dict passed to the rewrite handlers of one package.
+
+    resources_folder is a folder path or a ResourceProvider.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    sink = sink or DirectorySink()
+    if isinstance(resources_folder, ResourceProvider):
+        resources = resources_folder
+    else:
+        resources = FolderResources(resources_folder)
+    if (
+        dst_resources and settings['transfer'] == 'auto' and sink.writes_folder_tree
+        and resources.path(os.curdir) is not None
+    ):
+        settings['transfer'] = resolve_transfer_strategy(
+            'auto', resources.path(os.curdir), os.path.dirname(os.path.abspath(dst_resources))
+        )
+    return {
+        'resources': resources,
+        'ean_upc_code': ean_upc_code,
+        'config': settings['config'],
+        'dst_resources': dst_resources,
+        'manifest': {} if manifest is None else manifest,
+        'settings': settings,
+        'artwork': [],
+        'processed_artwork': {} if artwork is None else artwork,
+        'sink': sink,
+    }
+
+
+def xml_input(input_xml):
+    """Return (source for etree.parse/iterparse, size in bytes, name for log messages) of an XML input.
+
+    input_xml is a file path or the XML document as bytes; size is 0 for a missing file.
+    """
+    if isinstance(input_xml, (bytes, bytearray)):
+        return io.BytesIO(input_xml), len(input_xml), 'in-memory XML'
+    if not os.path.exists(input_xml):
+        return input_xml, 0, input_xml
+    return input_xml, os.path.getsize(input_xml), input_xml
+
+
+def convert_ddex_structure(input_xml_path, output_xml_path, resources_folder, ean_upc_code,
+                           dst_resources=None, manifest=None, settings=None, sink=None, artwork=None):
+    """Convert the structure of the DDEX XML; returns the manifest entry of the written XML, or None on error.
+
+    input_xml_path may also be the XML as bytes, and resources_folder a ResourceProvider.
+    """
+    source, source_size, source_name = xml_input(input_xml_path)
+    if not source_size:
+        logger.error(f"The file {source_name} does not exist or is empty.")
         return None
 
     try:
-        tree = etree.parse(input_xml_path)
+        with timed('parse'):
+            tree = etree.parse(source, SOURCE_PARSER)
     except etree.XMLSyntaxError as e:
-        logger.error(f"Error parsing XML file {input_xml_path}: {e}")
+        logger.error(f"Error parsing XML file {source_name}: {e}")
         return None
+    count('bytes_read', source_size)
 
     root = tree.getroot()
     ns = root.nsmap
-    new_nsmap = {'ern': 'http://ddex.net/xml/ern/382', 'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
-    new_root = etree.Element(
-        '{http://ddex.net/xml/ern/382}NewReleaseMessage',
-        nsmap=new_nsmap,
-        attrib={
-            'LanguageAndScriptCode': 'en',
-            '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation': 'http://ddex.net/xml/ern/382 http://ddex.net/xml/ern/382/release-notification.xsd',
-            'MessageSchemaVersionId': 'ern/382'
-        }
-    )
-    
-    sections = ['MessageHeader', 'UpdateIndicator', 'ResourceList', 'ReleaseList', 'DealList']
-    
-    for section in sections:
-        section_path = f'{{{ns["ern"]}}}{section}'
-        source_element = root.find(section_path)
-        if source_element is not None:
-            new_element = etree.SubElement(new_root, section, source_element.attrib)
-            deep_copy_element(source_element, new_element)
-        else:
-            source_element = root.find(section)
+    new_root = etree.Element(NEW_RELEASE_MESSAGE_TAG, nsmap=NEW_RELEASE_MESSAGE_NSMAP, attrib=NEW_RELEASE_MESSAGE_ATTRIB)
+
+    with timed('transplant'):
+        for section in DDEX_SECTIONS:
+            section_path = f'{{{ns["ern"]}}}{section}'
+            source_element = root.find(section_path)
+            if source_element is None:
+                source_element = root.find(section)
             if source_element is not None:
-                new_element = etree.SubElement(new_root, section, source_element.attrib)
-                deep_copy_element(source_element, new_element)
+                transplant_section(source_element, section, new_root)
             else:
                 logger.warning(f"Section {section} not found in input XML.")
+        # Drop the source document's namespace declarations that the copied sections no longer use
+        etree.cleanup_namespaces(new_root)
 
-    update_message_recipient(new_root)
-    update_image_metadata_and_hash(new_root, resources_folder)
-    update_icpn(new_root, ean_upc_code)
+    context = make_rewrite_context(resources_folder, ean_upc_code, dst_resources, manifest, settings, sink, artwork)
+    with timed('rewrite'):
+        apply_rewrites(new_root, context)
+    if context['settings']['xsd']:
+        with timed('validate'):
+            valid = validate_message(new_root, context['settings']['xsd'], output_xml_path)
+        if not valid:
+            return None
+    process_artwork(context)
 
-    new_tree = etree.ElementTree(new_root)
-    new_tree.write(output_xml_path, encoding='utf-8', xml_declaration=True, pretty_print=True)
-    return output_xml_path
+    with timed('serialize'):
+        new_tree = etree.ElementTree(new_root)
+        xml_data = etree.tostring(new_tree, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+        return context['sink'].write_bytes(output_xml_path, xml_data)
 
 
-def copy_resources(src_folder, dst_folder):
-    """Copy resource files from the source folder to the destination folder."""
-    if not os.path.exists(dst_folder):
-        os.makedirs(dst_folder)
-    for item in os.listdir(src_folder):
-        s = os.path.join(src_folder, item)
-        d = os.path.join(dst_folder, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, False, None)
-        else:
-            shutil.copy2(s, d)
+def convert_section(source_element, section, context):
+    """Copy one top-level section into a standalone element and apply the message rewrites to it."""
+    with timed('transplant'):
+        new_element = transplant_section(source_element, section)
+        etree.cleanup_namespaces(new_element)
+    with timed('rewrite'):
+        apply_rewrites(new_element, context)
+    process_artwork(context)
+    return new_element
 
 
-def create_batch_complete_xml(output_folder, batch_folder, package_folders, xml_file_names, message_ids, icpns, hash_sums):
-    """Create the BatchComplete XML file."""
-    batch_complete_path = os.path.join(output_folder, batch_folder, f'BatchComplete_{batch_folder}.xml')
+def convert_ddex_structure_streaming(input_xml_path, output_xml_path, resources_folder, ean_upc_code,
+                                     dst_resources=None, manifest=None, settings=None, sink=None, artwork=None):
+    """Convert the structure of the DDEX XML section by section, without loading the whole document.
+
+    Takes the same arguments and returns the same as convert_ddex_structure; settings['xsd'] is ignored.
+    """
+    source, source_size, source_name = xml_input(input_xml_path)
+    if not source_size:
+        logger.error(f"The file {source_name} does not exist or is empty.")
+        return None
+
+    context = make_rewrite_context(resources_folder, ean_upc_code, dst_resources, manifest, settings, sink, artwork)
+    if context['settings']['xsd']:
+        logger.warning(f"The streaming engine does not validate, {output_xml_path} is not checked against the XSD.")
+    written = set()
+    next_index = 0  # Position in DDEX_SECTIONS of the next section expected in schema order
+    try:
+        with context['sink'].open(output_xml_path) as output_file:
+            output_writer = HashingWriter(output_file)
+            with etree.xmlfile(output_writer, encoding='UTF-8') as xf:
+                xf.write_declaration()
+                with xf.element(NEW_RELEASE_MESSAGE_TAG, NEW_RELEASE_MESSAGE_ATTRIB, nsmap=NEW_RELEASE_MESSAGE_NSMAP):
+                    depth = 0
+                    source_root = None
+                    for event, element in etree.iterparse(source, events=('start', 'end'), remove_blank_text=True):
+                        if event == 'start':
+                            if source_root is None:
+                                source_root = element
+                            depth += 1
+                            continue
+                        depth -= 1
+                        if depth != 1:
+                            continue
 
+                        section = etree.QName(element).localname
+                        if section in DDEX_SECTIONS and section not in written and element.tag in (
+                            section, f'{{{source_root.nsmap.get("ern")}}}{section}'
+                        ):
+                            index = DDEX_SECTIONS.index(section)
+                            if index < next_index:
+                                logger.warning(f"Section {section} is out of schema order in {source_name}.")
+                            next_index = max(next_index, index + 1)
+
+                            new_element = convert_section(element, section, context)
+                            with timed('serialize'):
+                                etree.indent(new_element, level=1)
+                                xf.write('\n  ')
+                                xf.write(new_element)
+                            written.add(section)
+
+                        # The section is fully handled, drop it from the source tree
+                        element.clear()
+                        source_root.remove(element)
+
+                    for section in DDEX_SECTIONS:
+                        if section not in written:
+                            logger.warning(f"Section {section} not found in input XML.")
+                    xf.write('\n')
+                xf.flush()
+            output_writer.write(b'\n')
+    except etree.XMLSyntaxError as e:
+        logger.error(f"Error parsing XML file {source_name}: {e}")
+        context['sink'].discard(output_xml_path)
+        return None
+
+    count('bytes_read', source_size)
+    if context['sink'].writes_folder_tree:
+        count('bytes_written', output_writer.size)
+    return output_writer.manifest_entry()
+
+
+@dataclass
+class ConversionResult:
+    """A message converted by convert_ddex_message.
+
+    xml is the converted message and xml_entry its {'size': ..., 'md5': ...}. manifest holds the entry
+    of every resource whose hash went into the XML, by file name. artwork holds the upscaled images
+    by file name; they replace the source files in the delivered package.
+    """
+
+    xml: bytes
+    xml_entry: dict
+    manifest: dict
+    artwork: dict
+
+
+def convert_ddex_message(xml, resources, ean_upc_code, settings=None):
+    """Convert a single DDEX message in memory, for use as a library.
+
+    xml is the source message as bytes or a binary file object. resources is a ResourceProvider (e.g.
+    MemoryResources) or a resources folder path, only read for the files the XML references.
+    settings are merged into DEFAULT_SETTINGS; its 'config' (a ConverterConfig) sets the message
+    sender. Nothing is written to disk, except to settings['artwork_cache_dir'] if set.
+    Returns a ConversionResult, or None if the XML could not be converted.
+    """
+    if not isinstance(xml, (bytes, bytearray)):
+        xml = xml.read()
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    sink = MemorySink()
+    manifest = {}
+    artwork = {}
+    output_xml_path = f"{ean_upc_code}.xml"
+    convert = convert_ddex_structure_streaming if settings['streaming'] else convert_ddex_structure
+    with timed('convert'):
+        xml_entry = convert(xml, output_xml_path, resources, ean_upc_code, None, manifest, settings, sink, artwork)
+    if xml_entry is None:
+        return None
+    return ConversionResult(sink.files[output_xml_path], xml_entry, manifest, artwork)
+
+
+def copy_resources(src_folder, dst_folder, buffer_size=COPY_BUFFER_SIZE, manifest=None, transfer='copy', sink=None):
+    """Copy resource files from the source folder to the destination folder, hashing them on the way.
+
+    Returns the manifest {path relative to the folder: {'size': ..., 'md5': ...}}; see transfer_file
+    for the strategies, all but 'copy' leave 'md5' as None for files not hashed into the XML. Files already in the given manifest (e.g. artwork copied during conversion)
+    are not copied again. Files are written through sink (default: a DirectorySink).
+    """
+    if manifest is None:
+        manifest = {}
+    sink = sink or DirectorySink()
+    for dir_path, _, file_names in os.walk(src_folder, followlinks=True):
+        relative_dir = os.path.relpath(dir_path, src_folder)
+        sink.make_folder(os.path.join(dst_folder, relative_dir))
+        for file_name in file_names:
+            relative_path = os.path.normpath(os.path.join(relative_dir, file_name))
+            if relative_path not in manifest:
+                manifest[relative_path] = sink.transfer(
+                    os.path.join(dir_path, file_name), os.path.join(dst_folder, relative_path),
+                    transfer, buffer_size,
+                )
+    return manifest
+
+
+def batch_complete_root(message_count, config=None):
+    """Build the BatchComplete ManifestMessage root with its header, up to and including NumberOfMessages."""
+    config = config or DEFAULT_CONFIG
     new_nsmap = {
         'ern-c-sftp': 'http://ddex.net/xml/ern-c-sftp/16',
         'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
@@ -174,17 +1315,17 @@ def create_batch_complete_xml(output_folder, batch_folder, package_folders, xml_
     message_header = etree.SubElement(root, 'MessageHeader')
     message_sender = etree.SubElement(message_header, 'MessageSender')
     party_id = etree.SubElement(message_sender, 'PartyId')
-    party_id.text = MESSAGE_SENDER_PARTY_ID
+    party_id.text = config.message_sender_party_id
     party_name = etree.SubElement(message_sender, 'PartyName')
     full_name = etree.SubElement(party_name, 'FullName')
-    full_name.text = MESSAGE_SENDER_NAME
+    full_name.text = config.message_sender_name
     
     message_recipient = etree.SubElement(message_header, 'MessageRecipient')
     party_id = etree.SubElement(message_recipient, 'PartyId')
-    party_id.text = MESSAGE_SENDER_PARTY_ID
+    party_id.text = config.message_sender_party_id
     party_name = etree.SubElement(message_recipient, 'PartyName')
     full_name = etree.SubElement(party_name, 'FullName')
-    full_name.text = MESSAGE_SENDER_NAME
+    full_name.text = config.message_sender_name
     
     message_created_date_time = etree.SubElement(message_header, 'MessageCreatedDateTime')
     message_created_date_time.text = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
@@ -196,96 +1337,1385 @@ def create_batch_complete_xml(output_folder, batch_folder, package_folders, xml_
     root_directory.text = './'
     
     number_of_messages = etree.SubElement(root, 'NumberOfMessages')
-    number_of_messages.text = str(len(package_folders))
+    number_of_messages.text = str(message_count)
+    return root
+
+
+def message_in_batch_element(package_folder, xml_file_name, message_id, icpn, hash_sum):
+    """Build the MessageInBatch element of one converted package."""
+    message_in_batch = etree.Element('MessageInBatch')
+    message_type = etree.SubElement(message_in_batch, 'MessageType')
+    message_type.text = 'NewReleaseMessage'
+    
+    message_id_element = etree.SubElement(message_in_batch, 'MessageId')
+    message_id_element.text = message_id
+    
+    url = etree.SubElement(message_in_batch, 'URL')
+    url.text = f'./{package_folder}/{xml_file_name}'
+    
+    included_release_id = etree.SubElement(message_in_batch, 'IncludedReleaseId')
+    icpn_element = etree.SubElement(included_release_id, 'ICPN')
+    icpn_element.text = icpn
     
+    delivery_type = etree.SubElement(message_in_batch, 'DeliveryType')
+    delivery_type.text = 'NewReleaseDelivery'
+    
+    product_type = etree.SubElement(message_in_batch, 'ProductType')
+    product_type.text = 'AudioProduct'
+    
+    hash_sum_element = etree.SubElement(message_in_batch, 'HashSum')
+    hash_sum_value = etree.SubElement(hash_sum_element, 'HashSum')
+    hash_sum_value.text = hash_sum
+    hash_sum_algorithm_type = etree.SubElement(hash_sum_element, 'HashSumAlgorithmType')
+    hash_sum_algorithm_type.text = 'MD5'
+    return message_in_batch
+
+
+def create_batch_complete_xml(output_folder, batch_folder, package_folders, xml_file_names, message_ids, icpns, hash_sums,
+                              config=None):
+    """Create the BatchComplete XML file."""
+    batch_complete_path = os.path.join(output_folder, batch_folder, f'BatchComplete_{batch_folder}.xml')
+    root = batch_complete_root(len(package_folders), config)
     for i in range(len(package_folders)):
-        message_in_batch = etree.SubElement(root, 'MessageInBatch')
-        message_type = etree.SubElement(message_in_batch, 'MessageType')
-        message_type.text = 'NewReleaseMessage'
-        
-        message_id_element = etree.SubElement(message_in_batch, 'MessageId')
-        message_id_element.text = message_ids[i]
-        
-        url = etree.SubElement(message_in_batch, 'URL')
-        url.text = f'./{package_folders[i]}/{xml_file_names[i]}'
-        
-        included_release_id = etree.SubElement(message_in_batch, 'IncludedReleaseId')
-        icpn_element = etree.SubElement(included_release_id, 'ICPN')
-        icpn_element.text = icpns[i]
-        
-        delivery_type = etree.SubElement(message_in_batch, 'DeliveryType')
-        delivery_type.text = 'NewReleaseDelivery'
-        
-        product_type = etree.SubElement(message_in_batch, 'ProductType')
-        product_type.text = 'AudioProduct'
-        
-        hash_sum_element = etree.SubElement(message_in_batch, 'HashSum')
-        hash_sum_value = etree.SubElement(hash_sum_element, 'HashSum')
-        hash_sum_value.text = hash_sums[i]
-        hash_sum_algorithm_type = etree.SubElement(hash_sum_element, 'HashSumAlgorithmType')
-        hash_sum_algorithm_type.text = 'MD5'
+        root.append(message_in_batch_element(
+            package_folders[i], xml_file_names[i], message_ids[i], icpns[i], hash_sums[i]
+        ))
     
     new_tree = etree.ElementTree(root)
     new_tree.write(batch_complete_path, encoding='utf-8', xml_declaration=True, pretty_print=True)
 
 
-def main():
-    input_folder = './INPUT'  # Default input folder path
-    output_folder = './OUTPUT'  # Default output folder path
-
-    for batch_folder in os.listdir(input_folder):
-        batch_folder_path = os.path.join(input_folder, batch_folder)
-        if os.path.isdir(batch_folder_path):
-            package_folders = []
-            xml_file_names = []
-            message_ids = []
-            icpns = []
-            hash_sums = []
-            
-            for package_folder in os.listdir(batch_folder_path):
-                package_folder_path = os.path.join(batch_folder_path, package_folder)
-                if os.path.isdir(package_folder_path):
-                    input_xml_path = os.path.join(package_folder_path, f"{package_folder}.xml")
-                    logger.info(f"Processing XML file: {input_xml_path}")
-                    if os.path.exists(input_xml_path):
-                        resources_folder = os.path.join(package_folder_path, 'resources')
-                        if not os.path.exists(resources_folder):
-                            logger.error(
-                                f"The resources folder {resources_folder} does not exist. Skipping this package."
-                            )
-                            continue
+class BatchCompleteWriter:
+    """Writes a batch's BatchComplete XML incrementally, without keeping its entries in memory.
+
+    With a batch journal (journal_path) the records are the journal's 'done' lines, which are already
+    fsync'd and survive an interrupted run: only each package's index in the batch is kept here.
+    Without one (--no-journal, archive sinks) every converted package is appended as one line of a
+    .partial file next to the BatchComplete XML: "index<TAB>package_folder<TAB>MessageInBatch".
+    Results may arrive in any order; finalize() reads the records back in index order (keeping only
+    their offsets in memory) and streams the header, NumberOfMessages and the records into the same
+    XML as create_batch_complete_xml. With an archive sink the .partial file is kept in its scratch
+    folder and BatchComplete is its last member.
+    """
+
+    def __init__(self, output_folder, batch_folder, sink=None, config=None, journal_path=None):
+        self.config = config
+        self.batch_complete_path = os.path.join(output_folder, batch_folder, f'BatchComplete_{batch_folder}.xml')
+        self.sink = sink or DirectorySink()
+        self.journal_path = journal_path
+        self.partial_path = f"{self.sink.local_path(self.batch_complete_path)}.partial"
+        self.indexes = {}
+        self.file = None
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def add(self, index, package_folder, entry):
+        """Record the result (BatchComplete entry, or None if skipped) of the package at index."""
+        if entry is None:
+            return
+        if self.journal_path is not None:
+            self.indexes[package_folder] = index
+            return
+        record = etree.tostring(message_in_batch_element(
+            entry['package_folder'], entry['xml_file_name'], entry['message_id'], entry['icpn'], entry['hash_sum'],
+        ), encoding='UTF-8')
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.partial_path), exist_ok=True)
+            self.file = open(self.partial_path, 'ab')
+        self.file.write(b'%d\t%s\t%s\n' % (index, os.fsencode(package_folder), record))
+
+    def close_partial(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        """Drop the records without writing BatchComplete (its archive could not be completed)."""
+        self.close_partial()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def record_offsets(self, records):
+        """Return [(index, offset)] of the records to write, read from the journal or the .partial file."""
+        offsets = []
+        offset = 0
+        if self.journal_path is None:
+            for line in records:
+                offsets.append((int(line.split(b'\t', 1)[0]), offset))
+                offset += len(line)
+            return offsets
+        # Like load_batch_journal: a package's latest attempt counts, and only if this run added it
+        done = {}
+        for line in records:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = {'stage': None}
+            if record['stage'] == 'started':
+                done.pop(record['package'], None)
+            elif record['stage'] == 'done':
+                done[record['package']] = offset
+            offset += len(line)
+        return [(index, done[package_folder]) for package_folder, index in self.indexes.items() if package_folder in done]
+
+    def read_record(self, line):
+        """Return the MessageInBatch element of a record line."""
+        if self.journal_path is None:
+            return etree.fromstring(line.rstrip(b'\n').split(b'\t', 2)[2])
+        entry = json.loads(line)['entry']
+        return message_in_batch_element(
+            entry['package_folder'], entry['xml_file_name'], entry['message_id'], entry['icpn'], entry['hash_sum'],
+        )
+
+    def finalize(self):
+        """Write the BatchComplete XML from the records; nothing is written if no package succeeded."""
+        self.close_partial()
+        records_path = self.partial_path if self.journal_path is None else self.journal_path
+        if not os.path.exists(records_path):
+            return None
+        temporary_path = f"{self.sink.local_path(self.batch_complete_path)}.tmp"
+        with open(records_path, 'rb') as records:
+            offsets = sorted(self.record_offsets(records))
+            if offsets:
+                head = etree.tostring(
+                    batch_complete_root(len(offsets), self.config), encoding='UTF-8', xml_declaration=True,
+                    pretty_print=True,
+                )
+                head, _, closing_tag = head.rpartition(b'</')
+                with open(temporary_path, 'wb') as output:
+                    output.write(head)
+                    for _, offset in offsets:
+                        records.seek(offset)
+                        message_in_batch = self.read_record(records.readline())
+                        etree.indent(message_in_batch, level=1)
+                        output.write(b'  ' + etree.tostring(message_in_batch, encoding='UTF-8') + b'\n')
+                    output.write(b'</' + closing_tag)
+        if self.journal_path is None:
+            os.remove(self.partial_path)
+        if not offsets:
+            return None
+        self.sink.commit(temporary_path, self.batch_complete_path)
+        return self.batch_complete_path
+
+
+def describe_package_inputs(input_xml_md5, resources_folder, settings):
+    """Describe everything a package's output depends on: source XML, resource stats and settings."""
+    resources = {}
+    folders = [resources_folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    resources[os.path.relpath(entry.path, resources_folder)] = [stat.st_size, stat.st_mtime_ns]
+    inputs = {
+        'version': PACKAGE_CACHE_VERSION,
+        'input_xml_md5': input_xml_md5,
+        'resources': resources,
+        'settings': {
+            'message_sender_party_id': settings['config'].message_sender_party_id,
+            'message_sender_name': settings['config'].message_sender_name,
+            'streaming': settings['streaming'],
+        },
+    }
+    if settings['xsd']:
+        inputs['settings']['xsd'] = os.path.abspath(settings['xsd'])
+    return inputs
+
+
+def package_fingerprint(inputs):
+    """Content address of a package: the SHA-256 of its describe_package_inputs description."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def load_package_cache(cache_path):
+    """Load a package cache record, or None if there is no usable one."""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_package_cache(cache_path, record):
+    """Atomically write a package cache record."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def batch_journal_path(output_folder, batch_folder):
+    """Path of a batch's journal, kept next to its BatchComplete XML until the batch is finished."""
+    return os.path.join(output_folder, batch_folder, f'BatchComplete_{batch_folder}.journal')
+
+
+def append_batch_journal(journal_path, record):
+    """Append one JSON line to a batch journal and fsync it.
+
+    The line goes out in a single O_APPEND write, so worker processes can share the journal.
+    """
+    line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_batch_journal(journal_path):
+    """Return {package_folder: (entry, outputs)} for the packages a batch journal records as done.
+
+    Each package's latest attempt counts: 'started' forgets earlier records of the package, the
+    'xml' and 'resources' stages add their output files, 'done' carries the BatchComplete entry.
+    Only the output sizes are checked on resume; an output's 'md5' may be None (see transfer_file).
+    A torn line left by a crash is ignored.
+    """
+    attempts = {}
+    try:
+        with open(journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                package_folder = record['package']
+                if record['stage'] == 'started' or package_folder not in attempts:
+                    attempts[package_folder] = {'entry': None, 'outputs': {}}
+                attempts[package_folder]['outputs'].update(record.get('outputs', {}))
+                if record['stage'] == 'done':
+                    attempts[package_folder]['entry'] = record['entry']
+    except FileNotFoundError:
+        return {}
+    return {
+        package_folder: (attempt['entry'], attempt['outputs'])
+        for package_folder, attempt in attempts.items() if attempt['entry'] is not None
+    }
 
-                        output_xml_path = os.path.join(output_folder, batch_folder, package_folder, f"{package_folder}.xml")
-                        output_folder_path = os.path.dirname(output_xml_path)
-                        if os.path.exists(output_folder_path):
-                            shutil.rmtree(output_folder_path)
-                        os.makedirs(output_folder_path, exist_ok=True)
 
-                        output_xml_path = convert_ddex_structure(input_xml_path, output_xml_path, resources_folder, package_folder)
-                        if output_xml_path is None:
+def outputs_intact(output_folder_path, outputs):
+    """Check that every output file recorded for a package still exists with its recorded size."""
+    for relative_path, entry in outputs.items():
+        try:
+            if os.path.getsize(os.path.join(output_folder_path, relative_path)) != entry['size']:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def process_package(input_folder, output_folder, batch_folder, package_folder, settings=None, sink=None):
+    """Convert a single package and return its BatchComplete entry, or None if it was skipped.
+
+    The output goes through sink (default: a DirectorySink). Sinks that do not write the folder tree
+    keep no output folder to check, so packages are always converted and not journaled with them.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    sink = sink or DirectorySink()
+    if not sink.writes_folder_tree:
+        settings.update(incremental=False, journal=False)
+    package_folder_path = os.path.join(input_folder, batch_folder, package_folder)
+    input_xml_path = os.path.join(package_folder_path, f"{package_folder}.xml")
+    logger.info(f"Processing XML file: {input_xml_path}")
+    if not os.path.exists(input_xml_path):
+        logger.error(f"The XML file {input_xml_path} does not exist.")
+        return None
+
+    resources_folder = os.path.join(package_folder_path, 'resources')
+    if not os.path.exists(resources_folder):
+        logger.error(
+            f"The resources folder {resources_folder} does not exist. Skipping this package."
+        )
+        return None
+
+    output_xml_path = os.path.join(output_folder, batch_folder, package_folder, f"{package_folder}.xml")
+    output_folder_path = os.path.dirname(output_xml_path)
+    journal_path = batch_journal_path(output_folder, batch_folder)
+
+    if settings['incremental']:
+        cache_path = os.path.join(settings['cache_dir'], batch_folder, f"{package_folder}.json")
+        inputs = describe_package_inputs(
+            calculate_md5(input_xml_path, settings['buffer_size']), resources_folder, settings
+        )
+        cached = load_package_cache(cache_path)
+        if (
+            cached is not None
+            and cached['fingerprint'] == package_fingerprint(inputs)
+            and outputs_intact(output_folder_path, cached['outputs'])
+        ):
+            logger.info(f"Package {batch_folder}/{package_folder} is unchanged, reusing its previous output.")
+            if settings['journal']:
+                append_batch_journal(journal_path, {'package': package_folder, 'stage': 'started'})
+                append_batch_journal(journal_path, {
+                    'package': package_folder, 'stage': 'done', 'entry': cached['entry'], 'outputs': cached['outputs'],
+                })
+            return cached['entry']
+
+    sink.reset_folder(output_folder_path)
+    if settings['journal']:
+        append_batch_journal(journal_path, {'package': package_folder, 'stage': 'started'})
+
+    # Manifest of the package resources: artwork is hashed (and upscaled or copied) during conversion,
+    # the rest by copy_resources, so every file is read exactly once
+    manifest = {}
+    dst_resources = os.path.join(output_folder_path, 'resources')
+    if sink.writes_folder_tree:
+        transfer = resolve_transfer_strategy(settings['transfer'], resources_folder, output_folder_path)
+    else:
+        transfer = 'copy'
+    convert = convert_ddex_structure_streaming if settings['streaming'] else convert_ddex_structure
+    with timed('convert'):
+        xml_entry = convert(
+            input_xml_path, output_xml_path, resources_folder, package_folder,
+            dst_resources, manifest, {**settings, 'transfer': transfer}, sink,
+        )
+    if xml_entry is None:
+        return None
+    if settings['journal']:
+        append_batch_journal(journal_path, {
+            'package': package_folder, 'stage': 'xml', 'outputs': {f"{package_folder}.xml": xml_entry},
+        })
+
+    logger.info(f"Copying resources from {resources_folder} to {sink.archive_path or dst_resources} ({transfer})")
+    with timed('copy_resources'):
+        copy_resources(resources_folder, dst_resources, settings['buffer_size'], manifest, transfer, sink)
+    count('resources', len(manifest))
+    outputs = {
+        os.path.join('resources', relative_path): file_entry for relative_path, file_entry in manifest.items()
+    }
+
+    entry = {
+        'package_folder': package_folder,
+        'xml_file_name': f"{package_folder}.xml",
+        'message_id': package_folder,
+        'icpn': package_folder,
+        'hash_sum': xml_entry['md5'],
+    }
+    if settings['journal']:
+        append_batch_journal(journal_path, {
+            'package': package_folder, 'stage': 'resources', 'outputs': outputs,
+        })
+        append_batch_journal(journal_path, {'package': package_folder, 'stage': 'done', 'entry': entry})
+
+    if settings['incremental']:
+        outputs[entry['xml_file_name']] = xml_entry
+        save_package_cache(cache_path, {
+            'fingerprint': package_fingerprint(inputs),
+            'inputs': inputs,
+            'outputs': outputs,
+            'entry': entry,
+        })
+    return entry
+
+
+def start_profiling(profile):
+    """Start the opt-in per-package profiler ('cprofile' or 'tracemalloc'); returns the cProfile profiler."""
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if profile == 'tracemalloc':
+        tracemalloc.start()
+    return None
+
+
+def stop_profiling(profiler, settings, batch_folder, package_folder):
+    """Stop the per-package profiler and return what it adds to the package report."""
+    if settings['profile'] == 'cprofile':
+        profiler.disable()
+        profile_path = os.path.join(settings['profile_dir'], batch_folder, f"{package_folder}.prof")
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+        profiler.dump_stats(profile_path)
+        return {'profile': profile_path}
+    if settings['profile'] == 'tracemalloc':
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:TRACEMALLOC_TOP_LINES]
+        tracemalloc.stop()
+        return {'tracemalloc': {
+            'peak_bytes': peak,
+            'top': [{'line': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count} for stat in top],
+        }}
+    return {}
+
+
+def summarize_stats(reports):
+    """Add up the wall time, stage timings and counters of package reports."""
+    summary = {'packages': len(reports), 'converted': 0, 'seconds': 0.0, 'stages': {}, 'counters': {}}
+    for report in reports:
+        summary['converted'] += report['converted']
+        summary['seconds'] += report['seconds']
+        for name, stage in report['stages'].items():
+            total = summary['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+            total['seconds'] += stage['seconds']
+            total['calls'] += stage['calls']
+        for name, value in report['counters'].items():
+            summary['counters'][name] = summary['counters'].get(name, 0) + value
+    return summary
+
+
+def format_stats(stats):
+    """One-line summary of a package report or summarize_stats result for the log (the slowest stages only)."""
+    stages = ', '.join(
+        f"{name} {stage['seconds']:.2f} s"
+        for name, stage in sorted(stats['stages'].items(), key=lambda item: -item[1]['seconds'])[:LOGGED_STAGES]
+    )
+    counters = stats['counters']
+    return (
+        f"{stats['seconds']:.2f} s ({stages or 'no stages'}); "
+        f"read {counters.get('bytes_read', 0) / 1e6:.1f} MB, written {counters.get('bytes_written', 0) / 1e6:.1f} MB"
+    )
+
+
+def run_package(input_folder, output_folder, batch_folder, package_folder, settings=None, sink=None):
+    """Run process_package, logging failures instead of raising them so one package cannot stop the batch.
+
+    Returns (entry, report). With settings['report'] or settings['profile'] the report holds the
+    package's wall time, stage timings, counters and profile; otherwise it is None.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    instrumented = settings['report'] or settings['profile']
+    if instrumented:
+        global package_stats
+        package_stats = {'stages': {}, 'counters': {}}
+        profiler = start_profiling(settings['profile'])
+        started = time.perf_counter()
+    try:
+        entry = process_package(input_folder, output_folder, batch_folder, package_folder, settings, sink)
+    except Exception:
+        logger.exception(f"Failed to process package {batch_folder}/{package_folder}.")
+        entry = None
+    if not instrumented:
+        return entry, None
+
+    report = {
+        'package': package_folder,
+        'converted': entry is not None,
+        'seconds': time.perf_counter() - started,
+        **package_stats,
+        **stop_profiling(profiler, settings, batch_folder, package_folder),
+    }
+    package_stats = None
+    logger.info(f"Package {batch_folder}/{package_folder}: {format_stats(report)}")
+    return entry, report
+
+
+def batch_report(batch_folder, package_reports, resumed, batch_complete_seconds):
+    """Summarize a batch's package reports, log the summary and return the batch's report entry."""
+    summary = summarize_stats(package_reports)
+    logger.info(f"Batch {batch_folder}: {summary['packages']} packages, {format_stats(summary)}")
+    return {
+        'batch': batch_folder,
+        **summary,
+        'resumed': resumed,
+        'batch_complete_seconds': batch_complete_seconds,
+        'package_reports': package_reports,
+    }
+
+
+def write_report(report_path, settings, batch_reports, wall_seconds):
+    """Write the --report JSON file: run totals, then per-batch and per-package details."""
+    summary = summarize_stats([report for batch in batch_reports for report in batch['package_reports']])
+    logger.info(f"Total: {summary['packages']} packages in {wall_seconds:.2f} s, package time {format_stats(summary)}")
+    report = {
+        'created': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_seconds': wall_seconds,
+        'settings': {**settings, 'config': asdict(settings['config'])},
+        'total': summary,
+        'batches': batch_reports,
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Report written to {report_path}")
+
+
+def list_folders(folder):
+    """Return the names of a folder's sub-folders, sorted, or [] if the folder is gone.
+
+    The directory entries' types come with the listing, so no entry is stat'ed (except symlinks,
+    which are followed, and on filesystems that do not report types).
+    """
+    try:
+        with os.scandir(folder) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def find_batches(input_folder):
+    """Return (batch_folder, package_folders) pairs for the input folder, both sorted by name."""
+    return [
+        (batch_folder, list_folders(os.path.join(input_folder, batch_folder)))
+        for batch_folder in list_folders(input_folder)
+    ]
+
+
+@dataclass(frozen=True)
+class PackageDescriptor:
+    """A package folder found in INPUT, with the file stats the scheduler needs (see discover_packages).
+
+    xml_size is 0 if the package has no XML. newest_mtime_ns covers the XML and every resource.
+    """
+
+    batch_folder: str
+    package_folder: str
+    xml_path: str
+    resources_path: str
+    xml_size: int
+    resources_size: int
+    images: int
+    newest_mtime_ns: int
+
+    @property
+    def size(self):
+        return self.xml_size + self.resources_size
+
+
+def scan_package(input_folder, batch_folder, package_folder):
+    """Build a PackageDescriptor by walking the package's resources folder with os.scandir."""
+    package_folder_path = os.path.join(input_folder, batch_folder, package_folder)
+    xml_path = os.path.join(package_folder_path, f"{package_folder}.xml")
+    resources_path = os.path.join(package_folder_path, 'resources')
+    try:
+        xml_stat = os.stat(xml_path)
+        xml_size, newest_mtime_ns = xml_stat.st_size, xml_stat.st_mtime_ns
+    except OSError:
+        xml_size, newest_mtime_ns = 0, 0
+    resources_size = 0
+    images = 0
+    folders = [resources_path]
+    while folders:
+        try:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        folders.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        resources_size += stat.st_size
+                        newest_mtime_ns = max(newest_mtime_ns, stat.st_mtime_ns)
+                        if entry.name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                            images += 1
+        except OSError:
+            continue
+    return PackageDescriptor(
+        batch_folder, package_folder, xml_path, resources_path, xml_size, resources_size, images, newest_mtime_ns,
+    )
+
+
+def describe_package(input_folder, batch_folder, package_folder, cache=None):
+    """Return the PackageDescriptor of a package, from the cache if its folders did not change.
+
+    A cached descriptor is used while the mtimes of the package folder and of its resources folder
+    are unchanged, i.e. no file was added, removed or renamed there (files rewritten in place, or
+    changes in nested resource folders, are not noticed). Returns None if the package is gone.
+    """
+    package_folder_path = os.path.join(input_folder, batch_folder, package_folder)
+    try:
+        folder_mtime_ns = os.stat(package_folder_path).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        resources_mtime_ns = os.stat(os.path.join(package_folder_path, 'resources')).st_mtime_ns
+    except OSError:
+        resources_mtime_ns = None
+    if cache is None:
+        return scan_package(input_folder, batch_folder, package_folder)
+
+    key = f"{batch_folder}/{package_folder}"
+    record = cache.get(key)
+    if (
+        record is not None
+        and record['folder_mtime_ns'] == folder_mtime_ns
+        and record['resources_mtime_ns'] == resources_mtime_ns
+    ):
+        return PackageDescriptor(**record['descriptor'])
+    descriptor = scan_package(input_folder, batch_folder, package_folder)
+    cache[key] = {
+        'folder_mtime_ns': folder_mtime_ns,
+        'resources_mtime_ns': resources_mtime_ns,
+        'descriptor': asdict(descriptor),
+    }
+    return descriptor
+
+
+def discover_packages(input_folder, cache=None, batches=None):
+    """Yield a PackageDescriptor for every package in INPUT, lazily and in name order.
+
+    batches limits the scan to (batch_folder, package_folders) pairs as returned by find_batches.
+    With a cache dict (see load_discovery_cache), packages whose folders did not change are not
+    walked again (see describe_package). The cache is updated in place, and once the generator is
+    exhausted the entries of packages it did not see are dropped.
+    """
+    if batches is None:
+        batches = ((batch_folder, None) for batch_folder in list_folders(input_folder))
+    seen = set()
+    for batch_folder, package_folders in batches:
+        if package_folders is None:
+            package_folders = list_folders(os.path.join(input_folder, batch_folder))
+        for package_folder in package_folders:
+            descriptor = describe_package(input_folder, batch_folder, package_folder, cache)
+            if descriptor is not None:
+                seen.add(f"{batch_folder}/{package_folder}")
+                yield descriptor
+    if cache is not None:
+        for key in set(cache) - seen:
+            del cache[key]
+
+
+def load_discovery_cache(cache_path):
+    """Load the discovery cache {batch/package: record}, or an empty one if there is no usable file."""
+    cached = load_package_cache(cache_path)
+    if not isinstance(cached, dict) or cached.get('version') != DISCOVERY_CACHE_VERSION:
+        return {}
+    return cached['packages']
+
+
+def save_discovery_cache(cache_path, cache):
+    """Atomically write the discovery cache."""
+    save_package_cache(cache_path, {'version': DISCOVERY_CACHE_VERSION, 'packages': cache})
+
+
+def discover_batch_packages(input_folder, batches, settings):
+    """Return {(batch_folder, package_folder): PackageDescriptor} for the packages of batches.
+
+    With --incremental the descriptors are kept in the discovery cache between runs. They only feed
+    the scheduler's cost estimates; the incremental fingerprint stats every resource itself.
+    """
+    cache_path = os.path.join(settings['cache_dir'], DISCOVERY_CACHE_FILE) if settings['incremental'] else None
+    cache = load_discovery_cache(cache_path) if cache_path else None
+    descriptors = {
+        (descriptor.batch_folder, descriptor.package_folder): descriptor
+        for descriptor in discover_packages(input_folder, cache, batches)
+    }
+    if cache_path:
+        save_discovery_cache(cache_path, cache)
+    return descriptors
+
+
+def write_batch_complete(output_folder, batch_folder, entries, config=None):
+    """Write the BatchComplete XML for the successfully converted packages of a batch, in package order."""
+    entries = [entry for entry in entries if entry is not None]
+    if entries:
+        create_batch_complete_xml(
+            output_folder,
+            batch_folder,
+            [entry['package_folder'] for entry in entries],
+            [entry['xml_file_name'] for entry in entries],
+            [entry['message_id'] for entry in entries],
+            [entry['icpn'] for entry in entries],
+            [entry['hash_sum'] for entry in entries],
+            config,
+        )
+
+
+def resume_batch(output_folder, batch_folder, package_folders, settings):
+    """Return the entries of the packages an interrupted run of the batch finished, by package folder.
+
+    A package counts as finished if the batch journal records it as done and its output files
+    still have their recorded sizes; its entry is reused without converting or hashing it again.
+    """
+    if not settings['journal']:
+        return {}
+    finished = {}
+    for package_folder, (entry, outputs) in load_batch_journal(batch_journal_path(output_folder, batch_folder)).items():
+        if package_folder in package_folders and outputs_intact(
+            os.path.join(output_folder, batch_folder, package_folder), outputs
+        ):
+            finished[package_folder] = entry
+    if finished:
+        logger.info(
+            f"Resuming batch {batch_folder}: {len(finished)} of {len(package_folders)} packages were finished "
+            f"by an interrupted run."
+        )
+    return finished
+
+
+def finish_batch(output_folder, batch_folder, writer):
+    """Write a batch's BatchComplete XML, close its sink and drop its journal, which is no longer needed.
+
+    Returns the seconds it took.
+    """
+    started = time.perf_counter()
+    if writer.sink.failed:
+        writer.discard()
+    else:
+        writer.finalize()
+    writer.sink.close()
+    journal_path = batch_journal_path(output_folder, batch_folder)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    return time.perf_counter() - started
+
+
+def convert_batches(input_folder, output_folder, batches, settings=None):
+    """Convert all packages one after another in the current process.
+
+    Returns the batch reports (see batch_report) if instrumentation is on, an empty list otherwise.
+    With an archive output format each batch is streamed into OUTPUT/<batch>.tar or .zip; there is
+    no output folder to reuse or resume from, so --incremental and the journal do not apply.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if settings['output_format'] != 'directory':
+        if settings['incremental']:
+            logger.warning(f"--incremental does not apply to {settings['output_format']} output, converting every package.")
+        settings.update(incremental=False, journal=False)
+    batch_reports = []
+    for batch_folder, package_folders in batches:
+        finished = resume_batch(output_folder, batch_folder, package_folders, settings)
+        sink = open_sink(settings['output_format'], output_folder, batch_folder, settings['buffer_size'])
+        writer = BatchCompleteWriter(
+            output_folder, batch_folder, sink, settings['config'],
+            batch_journal_path(output_folder, batch_folder) if settings['journal'] else None,
+        )
+        package_reports = []
+        for index, package_folder in enumerate(package_folders):
+            if sink.failed:
+                logger.error(
+                    f"Skipping the last {len(package_folders) - index} packages of batch {batch_folder}, "
+                    f"its archive cannot be completed."
+                )
+                break
+            if package_folder in finished:
+                writer.add(index, package_folder, finished[package_folder])
+                continue
+            entry, package_report = run_package(input_folder, output_folder, batch_folder, package_folder, settings, sink)
+            writer.add(index, package_folder, entry)
+            if package_report is not None:
+                package_reports.append(package_report)
+        batch_complete_seconds = finish_batch(output_folder, batch_folder, writer)
+        if settings['report'] or settings['profile']:
+            batch_reports.append(batch_report(batch_folder, package_reports, len(finished), batch_complete_seconds))
+    return batch_reports
+
+
+def estimate_package_cost(descriptor, settings):
+    """Estimate a package's peak memory and the bytes it reads from its PackageDescriptor.
+
+    Only file sizes are used; no file is opened. Returns {'memory': bytes, 'io': bytes}.
+    """
+    xml_factor = STREAMING_XML_MEMORY_FACTOR if settings['streaming'] else XML_MEMORY_FACTOR
+    return {
+        'memory': (
+            PACKAGE_BASE_MEMORY + descriptor.xml_size * xml_factor + descriptor.images * ARTWORK_MEMORY
+            + settings['buffer_size']
+        ),
+        'io': descriptor.size,
+    }
+
+
+def default_memory_budget():
+    """Half of the physical memory, or None (no limit) where it cannot be determined."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class AdmissionControl:
+    """Decides which pending packages may start, keeping the running ones within budget.
+
+    At most slots packages run at once, and the sum of their estimated memory and I/O stays within
+    the budgets (None means no limit). Pending packages are tried largest first; one that does not
+    fit is passed over for smaller ones. A package larger than a whole budget runs alone.
+    """
+
+    def __init__(self, slots, memory_budget=None, io_budget=None):
+        self.slots = slots
+        self.budgets = {'memory': memory_budget, 'io': io_budget}
+        self.in_use = {'memory': 0, 'io': 0}
+        self.running = 0
+
+    def fits(self, cost):
+        return all(
+            budget is None or self.in_use[name] + cost[name] <= budget
+            for name, budget in self.budgets.items()
+        )
+
+    def admit(self, pending, costs):
+        """Remove and return the jobs of pending (sorted largest first) that may start now."""
+        admitted = []
+        for job in list(pending):
+            if self.running >= self.slots:
+                break
+            if self.running and not self.fits(costs[job]):
+                continue
+            pending.remove(job)
+            self.acquire(costs[job])
+            admitted.append(job)
+        return admitted
+
+    def acquire(self, cost):
+        self.running += 1
+        for name in self.in_use:
+            self.in_use[name] += cost[name]
+
+    def release(self, cost):
+        self.running -= 1
+        for name in self.in_use:
+            self.in_use[name] -= cost[name]
+
+
+def convert_batches_parallel(input_folder, output_folder, batches, workers, settings=None):
+    """Convert packages of all batches in a process pool.
+
+    Packages are scheduled largest first (by bytes to read) across all batches, and admitted only
+    while the estimated memory and I/O of the running ones stay within settings['memory_budget']
+    and settings['io_budget'] (see estimate_package_cost and AdmissionControl). Each batch's
+    BatchComplete XML is written as soon as its last package finishes, with entries in the same
+    order as the sequential mode. If a worker process dies (e.g. killed by the OOM killer) the pool
+    is rebuilt once and the packages that were still pending are resubmitted.
+
+    Returns the batch reports like convert_batches, with the workers' package reports in package order.
+    Archives are written by one process, so archive output formats are converted by convert_batches.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if settings['output_format'] != 'directory':
+        logger.warning(
+            f"{settings['output_format']} output is streamed by a single process, ignoring --workers {workers}."
+        )
+        return convert_batches(input_folder, output_folder, batches, settings)
+    instrumented = settings['report'] or settings['profile']
+    writers = {}
+    remaining = {}
+    resumed = {}
+    package_reports = {}
+    batch_reports = {}
+    jobs = []
+
+    def close_batch(batch_folder):
+        batch_complete_seconds = finish_batch(output_folder, batch_folder, writers[batch_folder])
+        if instrumented:
+            batch_reports[batch_folder] = batch_report(
+                batch_folder, [report for _, report in sorted(package_reports[batch_folder])],
+                resumed[batch_folder], batch_complete_seconds,
+            )
+
+    for batch_folder, package_folders in batches:
+        finished = resume_batch(output_folder, batch_folder, package_folders, settings)
+        writers[batch_folder] = BatchCompleteWriter(
+            output_folder, batch_folder, config=settings['config'],
+            journal_path=batch_journal_path(output_folder, batch_folder) if settings['journal'] else None,
+        )
+        remaining[batch_folder] = len(package_folders) - len(finished)
+        resumed[batch_folder] = len(finished)
+        package_reports[batch_folder] = []
+        for index, package_folder in enumerate(package_folders):
+            if package_folder in finished:
+                writers[batch_folder].add(index, package_folder, finished[package_folder])
+            else:
+                jobs.append((batch_folder, index, package_folder))
+        if remaining[batch_folder] == 0:
+            close_batch(batch_folder)
+
+    def record(job, entry, package_report):
+        batch_folder, index, package_folder = job
+        writers[batch_folder].add(index, package_folder, entry)
+        if package_report is not None:
+            package_reports[batch_folder].append((index, package_report))
+        remaining[batch_folder] -= 1
+        if remaining[batch_folder] == 0:
+            close_batch(batch_folder)
+
+    memory_budget = settings['memory_budget'] if settings['memory_budget'] is not None else default_memory_budget()
+    descriptors = discover_batch_packages(input_folder, batches, settings)
+    missing = PackageDescriptor('', '', '', '', 0, 0, 0, 0)
+    costs = {job: estimate_package_cost(descriptors.get((job[0], job[2]), missing), settings) for job in jobs}
+
+    def largest_first(jobs):
+        return sorted(jobs, key=lambda job: (-costs[job]['io'], -costs[job]['memory'], job[0], job[1]))
+
+    pending = largest_first(jobs)
+    if pending:
+        budgets = ', '.join(
+            f"{name} budget {'none' if budget is None else f'{budget / 1e6:.0f} MB'}"
+            for name, budget in (('memory', memory_budget), ('I/O', settings['io_budget']))
+        )
+        logger.info(f"Scheduling {len(pending)} packages largest first on {workers} workers, {budgets}.")
+
+    for attempt in range(2):
+        broken_jobs = []
+        broken = False
+        admission = AdmissionControl(workers, memory_budget, settings['io_budget'])
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            while pending or futures:
+                if not broken:
+                    for job in admission.admit(pending, costs):
+                        batch_folder, _, package_folder = job
+                        future = executor.submit(
+                            run_package, input_folder, output_folder, batch_folder, package_folder, settings
+                        )
+                        futures[future] = job
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    admission.release(costs[job])
+                    try:
+                        entry, package_report = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        if attempt == 0:
+                            broken_jobs.append(job)
                             continue
-                        
-                        dst_resources = os.path.join(output_folder, batch_folder, package_folder, 'resources')
-                        logger.info(f"Copying resources from {resources_folder} to {dst_resources}")
-                        copy_resources(resources_folder, dst_resources)
-                        
-                        hash_sum = calculate_md5(output_xml_path)
-                        
-                        message_id = package_folder
-                        icpn = package_folder
-                        xml_file_name = f"{package_folder}.xml"
-                        
-                        package_folders.append(package_folder)
-                        xml_file_names.append(xml_file_name)
-                        message_ids.append(message_id)
-                        icpns.append(icpn)
-                        hash_sums.append(hash_sum)
+                        logger.error(f"Worker process died while processing package {job[0]}/{job[2]}.")
+                        entry, package_report = None, None
+                    record(job, entry, package_report)
+
+        if not broken:
+            break
+        if attempt == 0:
+            pending = largest_first(broken_jobs + pending)
+            logger.warning(f"Process pool broke, retrying {len(pending)} pending packages in a new pool.")
+        else:
+            for job in pending:
+                logger.error(f"Package {job[0]}/{job[2]} was not converted, the process pool broke twice.")
+                record(job, None, None)
+    return [batch_reports[batch_folder] for batch_folder, _ in batches if batch_folder in batch_reports]
+
+
+class InotifyWatcher:
+    """Reports changed paths below a folder tree with Linux inotify (through ctypes, no extra dependency)."""
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}
+        self.add_tree(root)
+
+    def add_tree(self, path):
+        """Watch a folder and all folders below it (inotify watches are not recursive)."""
+        for dir_path, _, _ in os.walk(path, followlinks=True):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached, raise fs.inotify.max_user_watches")
+                continue  # the folder disappeared in the meantime
+            self.watches[wd] = dir_path
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return the changed paths, or None if the kernel dropped events."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                path = os.path.join(self.watches[wd], name) if name else self.watches[wd]
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                paths.append(path)
+        return None if overflow else paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback for InotifyWatcher (e.g. network mounts): compares folder mtimes every poll interval.
+
+    Creating, removing or renaming a file changes its folder's mtime, so a poll costs a listing per
+    batch and a couple of stat calls per package. A file rewritten in place is only noticed while its
+    package is still settling.
+    """
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.mtimes = self.scan()
+
+    def scan(self):
+        """Return the mtimes of the input, batch, package and package resources folders."""
+        mtimes = {}
+
+        def stat_folder(path):
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+
+        stat_folder(self.root)
+        with os.scandir(self.root) as batch_entries:
+            for batch_entry in batch_entries:
+                if not batch_entry.is_dir():
+                    continue
+                stat_folder(batch_entry.path)
+                try:
+                    with os.scandir(batch_entry.path) as package_entries:
+                        for package_entry in package_entries:
+                            if package_entry.is_dir():
+                                stat_folder(package_entry.path)
+                                stat_folder(os.path.join(package_entry.path, 'resources'))
+                except OSError:
+                    continue
+        return mtimes
+
+    def read(self, timeout):
+        """Sleep one poll interval and return the folders whose mtime changed, appeared or disappeared."""
+        time.sleep(self.interval)
+        mtimes = self.scan()
+        changed = [path for path in mtimes.keys() | self.mtimes.keys() if mtimes.get(path) != self.mtimes.get(path)]
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+
+def package_signature(package_folder_path):
+    """Return the sorted (path, size, mtime) listing of a package folder, or None if the folder is gone."""
+    if not os.path.isdir(package_folder_path):
+        return None
+    files = []
+    for dir_path, _, file_names in os.walk(package_folder_path, followlinks=True):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            files.append((os.path.relpath(file_path, package_folder_path), stat.st_size, stat.st_mtime_ns))
+    files.sort()
+    return files
+
+
+def has_ready_marker(folder, ready_marker):
+    """Whether a folder directly contains a file matching the ready marker pattern."""
+    try:
+        return any(fnmatch.fnmatch(file_name, ready_marker) for file_name in os.listdir(folder))
+    except OSError:
+        return False
+
+
+def ignore_stop_signals():
+    """Worker initializer for watch mode: stopping is left to the main process, which drains the pool."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def watch_input(input_folder, output_folder, settings=None, workers=1, settle_seconds=WATCH_SETTLE_SECONDS,
+                ready_marker=None, polling=False, poll_interval=WATCH_POLL_INTERVAL):
+    """Keep running and convert each package as soon as its upload is complete.
+
+    A package is complete when its files have not changed for settle_seconds or, with a ready_marker
+    pattern, when a matching file exists in its package or batch folder. Packages already in INPUT at
+    start-up are converted first. A package is converted again when its files change, and a batch's
+    BatchComplete XML is rewritten whenever none of its packages is pending. Stops on SIGINT/SIGTERM.
+    Batches never finish in watch mode, so no batch journal is kept.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {}), 'journal': False}
+    watcher = None
+    if not polling:
+        try:
+            watcher = InotifyWatcher(input_folder)
+        except (OSError, AttributeError) as error:
+            logger.warning(f"inotify is not available ({error}), polling {input_folder} instead.")
+    if watcher is None:
+        watcher = PollingWatcher(input_folder, poll_interval)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_stop_signals) if workers > 1 else None
+
+    pending = {}    # (batch, package) -> {'signature', 'changed'} of packages that may need converting
+    converted = {}  # (batch, package) -> signature of the files the last conversion saw
+    running = {}    # future -> ((batch, package), signature, pool)
+    retried = set()
+    entries = {}    # batch -> {package: BatchComplete entry}
+    dirty_batches = set()
+
+    def note_package(unit, changed):
+        # changed is None only for packages found at start-up; an event restarts the settle time
+        state = pending.get(unit)
+        if state is None:
+            pending[unit] = {'signature': None, 'changed': changed}
+        elif changed is not None:
+            state['changed'] = changed
+
+    def note_batch(batch_folder, changed):
+        for package_folder in list_folders(os.path.join(input_folder, batch_folder)):
+            note_package((batch_folder, package_folder), changed)
+
+    def note_path(path, changed):
+        parts = os.path.relpath(path, input_folder).split(os.sep)
+        if parts[0] in (os.curdir, os.pardir):
+            for batch_folder, _ in find_batches(input_folder):
+                note_batch(batch_folder, changed)
+        elif len(parts) == 1 or not os.path.isdir(os.path.join(input_folder, parts[0], parts[1])):
+            # a new batch folder, or a file such as a ready marker directly inside a batch folder
+            note_batch(parts[0], changed)
+        else:
+            note_package((parts[0], parts[1]), changed)
+
+    def finish(unit, signature, entry):
+        batch_folder, package_folder = unit
+        converted[unit] = signature
+        if entry is None:
+            entries.setdefault(batch_folder, {}).pop(package_folder, None)
+        else:
+            entries.setdefault(batch_folder, {})[package_folder] = entry
+        dirty_batches.add(batch_folder)
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info(f"Watching {input_folder} ({type(watcher).__name__}), converting into {output_folder}.")
+    note_path(input_folder, None)
+    try:
+        while True:
+            # Collect finished conversions; a broken pool is rebuilt once and its packages requeued
+            for future in [future for future in running if future.done()]:
+                unit, signature, pool = running.pop(future)
+                try:
+                    finish(unit, signature, future.result()[0])
+                except BrokenProcessPool:
+                    if unit in retried:
+                        logger.error(f"Worker process died while processing package {unit[0]}/{unit[1]}.")
+                        finish(unit, signature, None)
                     else:
-                        logger.error(f"The XML file {input_xml_path} does not exist.")
-            
-            if package_folders:
-                create_batch_complete_xml(output_folder, batch_folder, package_folders, xml_file_names, message_ids, icpns, hash_sums)
+                        retried.add(unit)
+                        pending[unit] = {'signature': None, 'changed': None}
+                        if pool is executor:
+                            logger.warning("Process pool broke, converting the pending packages in a new pool.")
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_stop_signals)
+
+            # Start every pending package whose files have settled (or that has its ready marker)
+            now = time.time()
+            busy = {unit for unit, _, _ in running.values()}
+            for unit, state in list(pending.items()):
+                if unit in busy:
+                    continue
+                batch_folder, package_folder = unit
+                package_folder_path = os.path.join(input_folder, batch_folder, package_folder)
+                signature = package_signature(package_folder_path)
+                if signature is None:
+                    del pending[unit]
+                    continue
+                if signature != state['signature']:
+                    if state['changed'] is None:
+                        # Already in INPUT at start-up: the newest file mtime tells how long ago the upload last wrote
+                        newest = max((mtime for _, _, mtime in signature), default=0) / 1e9
+                        state['changed'] = min(newest, now)
+                    else:
+                        state['changed'] = now
+                    state['signature'] = signature
+                if f"{package_folder}.xml" not in (path for path, _, _ in signature):
+                    # Nothing to convert yet, however long the folder has been quiet
+                    continue
+                if ready_marker:
+                    ready = (
+                        has_ready_marker(package_folder_path, ready_marker)
+                        or has_ready_marker(os.path.join(input_folder, batch_folder), ready_marker)
+                    )
+                else:
+                    ready = now - state['changed'] >= settle_seconds
+                if not ready:
+                    continue
+                del pending[unit]
+                if converted.get(unit) == signature:
+                    continue
+                logger.info(f"Package {batch_folder}/{package_folder} is complete, converting it.")
+                if executor is None:
+                    finish(unit, signature, run_package(input_folder, output_folder, batch_folder, package_folder, settings)[0])
+                else:
+                    future = executor.submit(run_package, input_folder, output_folder, batch_folder, package_folder, settings)
+                    running[future] = (unit, signature, executor)
+
+            # Rewrite BatchComplete for every batch that changed and has nothing left in flight
+            busy = {unit[0] for unit in pending} | {unit[0] for unit, _, _ in running.values()}
+            for batch_folder in sorted(dirty_batches - busy):
+                batch_entries = entries.get(batch_folder, {})
+                write_batch_complete(output_folder, batch_folder, [batch_entries[name] for name in sorted(batch_entries)], settings['config'])
+                dirty_batches.discard(batch_folder)
+
+            changes = watcher.read(1.0 if pending or running else 60.0)
+            if changes is None:
+                logger.warning("inotify queue overflowed, rescanning the whole input folder.")
+                changes = [input_folder]
+            now = time.time()
+            for path in changes:
+                note_path(path, now)
+    except KeyboardInterrupt:
+        logger.info("Stopping watch mode.")
+    finally:
+        watcher.close()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert DDEX 3.8.2 packages and build BatchComplete manifests.")
+    parser.add_argument('--input', default='./INPUT', help="Input folder with batch folders (default: ./INPUT).")
+    parser.add_argument('--output', default='./OUTPUT', help="Output folder (default: ./OUTPUT).")
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help="Number of packages converted in parallel worker processes (default: 1, no process pool).",
+    )
+    parser.add_argument(
+        '--memory-budget', type=int, default=None,
+        help="With --workers, MB of estimated package memory allowed to run at once "
+             "(default: half of the physical memory).",
+    )
+    parser.add_argument(
+        '--io-budget', type=int, default=None,
+        help="With --workers, MB of estimated package reads allowed in flight at once (default: no limit).",
+    )
+    parser.add_argument(
+        '--sender-party-id', default=DEFAULT_CONFIG.message_sender_party_id,
+        help="PartyId of the message sender and recipient written into messages and BatchComplete.",
+    )
+    parser.add_argument(
+        '--sender-name', default=DEFAULT_CONFIG.message_sender_name,
+        help="FullName of the message sender and recipient written into messages and BatchComplete.",
+    )
+    parser.add_argument(
+        '--streaming', action='store_true',
+        help="Convert XML section by section with iterparse instead of loading whole messages into memory.",
+    )
+    parser.add_argument(
+        '--xsd', default=None,
+        help="Validate every converted message against this local XSD (e.g. the ERN 3.8.2 "
+             "release-notification.xsd) before it is written; invalid packages are skipped.",
+    )
+    parser.add_argument(
+        '--buffer-size', type=int, default=COPY_BUFFER_SIZE,
+        help=f"Read/write buffer in bytes for copying and hashing resources (default: {COPY_BUFFER_SIZE}).",
+    )
+    parser.add_argument(
+        '--transfer', choices=TRANSFER_STRATEGIES, default='auto',
+        help="How resources get to OUTPUT (default: auto = reflink/copy_file_range on the same filesystem, "
+             "copy otherwise). hardlink output files share inodes with INPUT and must not be edited in place.",
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="Skip packages whose source XML, resources and settings are unchanged since the last run "
+             "and whose output is still in place.",
+    )
+    parser.add_argument(
+        '--cache-dir', default='./.ddex_cache',
+        help="Folder for the per-package records of --incremental (default: ./.ddex_cache).",
+    )
+    parser.add_argument(
+        '--artwork-threads', type=int, default=4,
+        help="Threads per package for decoding, upscaling, encoding and hashing artwork (default: 4).",
+    )
+    parser.add_argument(
+        '--artwork-cache-dir', default=None,
+        help="Folder for upscaled artwork keyed by source image MD5, shared by all workers and runs "
+             "(default: in-memory cache per process only).",
+    )
+    parser.add_argument(
+        '--no-journal', action='store_true',
+        help="Do not keep the per-batch journal that lets an interrupted run resume where it stopped.",
+    )
+    parser.add_argument(
+        '--report', default=None,
+        help="Time every stage (parse, transplant, rewrite, artwork, copy, hash, ...), count bytes read and "
+             "written, log per-package and per-batch summaries and write them to this JSON file.",
+    )
+    parser.add_argument(
+        '--profile', choices=['cprofile', 'tracemalloc'], default=None,
+        help="Profile every package: cprofile writes <profile-dir>/<batch>/<package>.prof, tracemalloc adds "
+             "peak memory and the top allocation sites to the package summary.",
+    )
+    parser.add_argument(
+        '--profile-dir', default='./ddex_profiles',
+        help="Folder for the --profile cprofile files (default: ./ddex_profiles).",
+    )
+    parser.add_argument(
+        '--output-format', choices=OUTPUT_FORMATS, default='directory',
+        help="directory writes the OUTPUT tree (default); tar and zip stream each batch into OUTPUT/<batch>.tar "
+             "or .zip, with BatchComplete as the last member. Archives are written by a single process.",
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="Keep running and convert each package as soon as it is completely uploaded to the input folder.",
+    )
+    parser.add_argument(
+        '--settle-time', type=float, default=WATCH_SETTLE_SECONDS,
+        help=f"With --watch, seconds a package's files must stay unchanged before it is converted "
+             f"(default: {WATCH_SETTLE_SECONDS:g}).",
+    )
+    parser.add_argument(
+        '--ready-marker', default=None,
+        help="With --watch, convert a package only once a file matching this pattern (e.g. 'BatchComplete*') "
+             "exists in its package or batch folder, instead of waiting for --settle-time.",
+    )
+    parser.add_argument(
+        '--poll', action='store_true',
+        help="With --watch, poll folder mtimes instead of using inotify (needed on NFS/SMB mounts).",
+    )
+    parser.add_argument(
+        '--poll-interval', type=float, default=WATCH_POLL_INTERVAL,
+        help=f"Seconds between polls with --poll or when inotify is unavailable (default: {WATCH_POLL_INTERVAL:g}).",
+    )
+    args = parser.parse_args()
+    if args.watch and args.output_format != 'directory':
+        parser.error("--watch only supports --output-format directory")
+    if args.xsd and args.streaming:
+        parser.error("--xsd validates the whole message tree and cannot be combined with --streaming")
+    return args
+
+
+def main():
+    args = parse_args()
+    settings = {
+        'streaming': args.streaming,
+        'buffer_size': args.buffer_size,
+        'transfer': args.transfer,
+        'incremental': args.incremental,
+        'cache_dir': args.cache_dir,
+        'artwork_threads': args.artwork_threads,
+        'artwork_cache_dir': args.artwork_cache_dir,
+        'journal': not args.no_journal,
+        'report': args.report is not None,
+        'profile': args.profile,
+        'profile_dir': args.profile_dir,
+        'output_format': args.output_format,
+        'config': ConverterConfig(args.sender_party_id, args.sender_name),
+        'xsd': args.xsd,
+        'memory_budget': args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None,
+        'io_budget': args.io_budget * 1024 * 1024 if args.io_budget is not None else None,
+    }
+    if args.xsd:
+        # Compiled before any worker is forked, so workers start with the schema already loaded
+        load_schema(args.xsd)
+    if args.watch:
+        watch_input(
+            args.input, args.output, settings, args.workers, args.settle_time,
+            args.ready_marker, args.poll, args.poll_interval,
+        )
+        return
+
+    started = time.perf_counter()
+    batches = find_batches(args.input)
+    if args.workers > 1:
+        batch_reports = convert_batches_parallel(args.input, args.output, batches, args.workers, settings)
+    else:
+        batch_reports = convert_batches(args.input, args.output, batches, settings)
+    if args.report:
+        write_report(args.report, settings, batch_reports, time.perf_counter() - started)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()